@@ -0,0 +1,97 @@
+import asyncio
+import os
+import random
+import string
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+import httpx
+from fastapi import FastAPI
+
+""" Benchmarks sign up and hammer from one host, set RATE_LIMIT=True to measure the limiter. """
+os.environ.setdefault("RATE_LIMIT", "False")
+
+
+@asynccontextmanager
+async def started(app: FastAPI) -> AsyncIterator[FastAPI]:
+    """ Runs the startup and shutdown handlers around the benchmark. """
+    await app.router.startup()
+    try:
+        yield app
+    finally:
+        await app.router.shutdown()
+
+
+def client(app: FastAPI, host: str = "127.0.0.1") -> httpx.AsyncClient:
+    """ In-process client, host sets request.client.host. """
+    transport = httpx.ASGITransport(app=app, client=(host, 50000))  # type: ignore[arg-type]
+    return httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+
+async def signup_and_login(session: httpx.AsyncClient) -> dict:
+    """ Creates a throwaway user and returns it with its tokens. """
+    name = "bench" + "".join(random.choices(string.ascii_lowercase, k=12))
+    user = {
+        "username": name,
+        "first_name": "bench",
+        "last_name": "bench",
+        "email": f"{name}@bench.bench",
+        "password": name,
+    }
+    response = await session.post("/api/users/signup", json=user)
+    response.raise_for_status()
+    user["id"] = response.json()["id"]
+    response = await session.post(
+        "/api/auth/token/login",
+        data={"username": user["username"], "password": user["password"]},
+    )
+    response.raise_for_status()
+    user.update(response.json())
+    return user
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def drive(
+    request: Callable[[int], Awaitable[httpx.Response]],
+    total: int,
+    concurrency: int,
+) -> dict:
+    """
+    Sends total requests from concurrency workers,
+    request receives the worker number.
+    """
+    latencies: list[float] = []
+    errors = 0
+    left = iter(range(total))
+
+    async def worker(number: int) -> None:
+        nonlocal errors
+        for _ in left:
+            start = time.perf_counter()
+            response = await request(number)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def report(name: str, stats: dict) -> None:
+    print(name, " ".join(f"{key}={value}" for key, value in stats.items()))
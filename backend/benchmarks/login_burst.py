@@ -0,0 +1,55 @@
+"""
+Feed latency under a login burst.
+
+Measures GET /api/posts alone, then again while login workers
+keep running bcrypt verification in the same process.
+Run from the backend folder against a scratch database:
+
+    python -m benchmarks.login_burst --requests 1000 --concurrency 20 --logins 8
+"""
+import argparse
+import asyncio
+
+import httpx
+from benchmarks.common import client, drive, report, signup_and_login, started
+from main import app
+
+
+async def main(total: int, concurrency: int, logins: int) -> None:
+    async with started(app), client(app) as session:
+        user = await signup_and_login(session)
+        headers = {"authorization": f"Bearer {user['access_token']}"}
+        for i in range(20):
+            await session.post("/api/posts/create", json={"text": f"burst {i}"}, headers=headers)
+
+        async def feed(number: int) -> httpx.Response:
+            return await session.get("/api/posts/")
+
+        report("feed_alone", await drive(feed, total, concurrency))
+
+        done = asyncio.Event()
+        statuses: dict[int, int] = {}
+
+        async def login() -> None:
+            while not done.is_set():
+                response = await session.post(
+                    "/api/auth/token/login",
+                    data={"username": user["username"], "password": user["password"]},
+                )
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        burst = [asyncio.create_task(login()) for _ in range(logins)]
+        stats = await drive(feed, total, concurrency)
+        done.set()
+        await asyncio.gather(*burst)
+        report("feed_with_logins", stats)
+        print("login_statuses", statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.logins))
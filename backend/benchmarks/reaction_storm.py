@@ -0,0 +1,55 @@
+"""
+Likes and dislikes on one post from many users at once.
+
+Run once as is and once with REACTIONS_WRITE_BEHIND=True,
+the counters in Postgres are printed after shutdown has flushed them:
+
+    python -m benchmarks.reaction_storm --requests 4000 --concurrency 50 --users 50
+"""
+import argparse
+import asyncio
+
+import httpx
+from benchmarks.common import client, drive, report, signup_and_login, started
+from db import database
+from main import app
+from posts.utils import db_like
+
+
+async def main(total: int, concurrency: int, users: int) -> None:
+    async with started(app), client(app) as session:
+        author = await signup_and_login(session)
+        response = await session.post(
+            "/api/posts/create",
+            json={"text": "storm"},
+            headers={"authorization": f"Bearer {author['access_token']}"},
+        )
+        post_id = response.json()["id"]
+        headers = [
+            {"authorization": f"Bearer {(await signup_and_login(session))['access_token']}"}
+            for _ in range(users)
+        ]
+
+        async def react(number: int) -> httpx.Response:
+            reaction = "like" if number % 3 else "dislike"
+            return await session.post(
+                f"/api/posts/{post_id}/{reaction}", headers=headers[number % users]
+            )
+
+        report("reactions", await drive(react, total, concurrency))
+        answered = (await session.get(f"/api/posts/{post_id}")).json()
+
+    await database.connect()
+    stored = await db_like.count(post_id)
+    await database.disconnect()
+    print("answered", answered["like"], answered["dislike"])
+    print("stored", stored["like"], stored["dislike"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.users))
@@ -0,0 +1,63 @@
+"""
+Concurrency benchmark for the endpoints that talk to Redis:
+GET /api/posts/{post_id} and POST /api/auth/token/refresh.
+
+Runs the app in-process, so the clients share its event loop and
+any blocking call shows up directly as lost throughput.
+Run from the backend folder against a scratch database:
+
+    python -m benchmarks.redis_concurrency --requests 3000 --concurrency 50
+"""
+import argparse
+import asyncio
+
+import httpx
+from benchmarks.common import client, drive, report, signup_and_login, started
+from main import app
+
+
+async def main(total: int, concurrency: int) -> None:
+    async with started(app), client(app) as session:
+        user = await signup_and_login(session)
+        headers = {"authorization": f"Bearer {user['access_token']}"}
+        response = await session.post(
+            "/api/posts/create", json={"text": "benchmark"}, headers=headers
+        )
+        post_id = response.json()["id"]
+
+        async def get_post(number: int) -> httpx.Response:
+            return await session.get(f"/api/posts/{post_id}")
+
+        report("get_post", await drive(get_post, total, concurrency))
+
+        # Refresh tokens are bound to the client host and capped per user,
+        # so every worker refreshes its own session from its own address.
+        workers = min(concurrency, 8)
+        hosts = [client(app, f"10.0.0.{i + 1}") for i in range(workers)]
+        tokens = []
+        for host in hosts:
+            response = await host.post(
+                "/api/auth/token/login",
+                data={"username": user["username"], "password": user["password"]},
+            )
+            tokens.append(response.json()["refresh_token"])
+
+        async def refresh(number: int) -> httpx.Response:
+            response = await hosts[number].post(
+                "/api/auth/token/refresh", json={"refresh_token": tokens[number]}
+            )
+            if response.status_code == 200:
+                tokens[number] = response.json()["refresh_token"]
+            return response
+
+        report("token_refresh", await drive(refresh, total, workers))
+        for host in hosts:
+            await host.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,83 @@
+"""
+GET /api/posts/search as the posts table grows.
+
+Fills the table up to each size with generated posts of twelve words
+drawn log-uniformly from a vocabulary, so a few words are in most posts
+and most words are rare, then measures the first page of a few queries.
+Run from the backend folder against a scratch database:
+
+    python -m benchmarks.search --sizes 100000,1000000 --requests 200 --concurrency 10
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+import sqlalchemy as sa
+from benchmarks.common import client, drive, report, signup_and_login, started
+from db import database
+from main import app
+
+VOCABULARY = 20000
+BATCH = 100000
+
+QUERIES = {
+    "common": "w1",
+    "medium": "w100",
+    "rare": "w15000",
+    "two_words": "w3 w40",
+    "phrase": '"w1 w2"',
+    "missing": "nothing",
+}
+
+GENERATE = sa.text(
+    """
+    INSERT INTO posts (text, author, timestamp, search_vector)
+    SELECT generated.text, CAST(:author AS int), now() - number * interval '1 second',
+        to_tsvector('simple', generated.text)
+    FROM generate_series(CAST(:start AS int), CAST(:stop AS int)) AS number,
+    LATERAL (
+        SELECT string_agg(
+            'w' || floor(exp(random() * ln(CAST(:vocabulary AS int))))::int, ' '
+        ) AS text
+        FROM generate_series(1, 12) WHERE number > 0
+    ) AS generated
+    """
+)
+
+
+async def fill(author: int, size: int) -> None:
+    current = await database.fetch_val(sa.text("SELECT count(*) FROM posts"))
+    started_at = time.perf_counter()
+    for start in range(current + 1, size + 1, BATCH):
+        await database.execute(GENERATE.bindparams(
+            author=author, start=start, stop=min(start + BATCH - 1, size), vocabulary=VOCABULARY
+        ))
+    await database.execute(sa.text("VACUUM ANALYZE posts"))
+    print("posts", size, "filled_s", round(time.perf_counter() - started_at, 1))
+
+
+async def main(sizes: list[int], total: int, concurrency: int, limit: int) -> None:
+    async with started(app), client(app) as session:
+        author = (await signup_and_login(session))["id"]
+        for size in sizes:
+            await fill(author, size)
+            for name, text in QUERIES.items():
+
+                async def search(number: int, text: str = text) -> httpx.Response:
+                    return await session.get(
+                        "/api/posts/search", params={"q": text, "limit": limit}
+                    )
+
+                report(f"{size}_{name}", await drive(search, total, concurrency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100000,1000000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    sizes = [int(i) for i in args.sizes.split(",")]
+    asyncio.run(main(sizes, args.requests, args.concurrency, args.limit))
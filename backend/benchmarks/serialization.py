@@ -0,0 +1,76 @@
+"""
+Encoding a page of posts: the pydantic path FastAPI takes for the response
+model against the orjson fast path of FAST_JSON. Needs no database:
+
+    python -m benchmarks.serialization --rows 6,50,200 --rounds 2000
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Callable
+
+import orjson
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute, serialize_response
+from posts import serializers
+from posts.api_posts import router
+
+
+def rows(count: int) -> list[dict]:
+    """ Rows as the feed query returns them, with the columns the schema leaves out. """
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "id": i, "text": f"post number {i} " * 8, "author": i % 50, "timestamp": now,
+            "update_date": None if i % 3 else now, "like_count": i, "dislike_count": 0,
+            "like": i, "dislike": 0, "total": count,
+        }
+        for i in range(count)
+    ]
+
+
+def page(count: int) -> dict:
+    return {
+        "count": count,
+        "next": "http://bench/api/posts/?page=2",
+        "previous": None,
+        "results": rows(count),
+    }
+
+
+async def pydantic_path(result: dict) -> bytes:
+    route = next(i for i in router.routes if isinstance(i, APIRoute) and i.name == "get_posts")
+    content = await serialize_response(field=route.response_field, response_content=result)
+    return JSONResponse(content).body
+
+
+async def fast_path(result: dict) -> bytes:
+    return serializers.dump_list(result)
+
+
+async def measure(encode: Callable, result: dict, rounds: int) -> float:
+    """ Microseconds per page. """
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        await encode(result)
+    return (time.perf_counter() - started_at) / rounds * 1e6
+
+
+async def main(sizes: list[int], rounds: int) -> None:
+    serializers.FAST_JSON = True
+    for size in sizes:
+        result = page(size)
+        assert orjson.loads(await fast_path(result)) == orjson.loads(await pydantic_path(result))
+        assert tuple(orjson.loads(await fast_path(result))["results"][0]) == serializers.POST_FIELDS
+        slow = await measure(pydantic_path, result, rounds)
+        fast = await measure(fast_path, result, rounds)
+        print(f"rows={size} pydantic_us={slow:.1f} fast_us={fast:.1f} speedup={slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", default="6,50,200")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main([int(i) for i in args.rows.split(",")], args.rounds))
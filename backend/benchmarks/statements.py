@@ -0,0 +1,52 @@
+"""
+CPU time of the hot lookups by primary key, called directly and through
+GET /api/posts/{id}. Process time is counted, so the wait for Postgres
+is left out and what remains is the Python side:
+
+    python -m benchmarks.statements --calls 5000
+"""
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from benchmarks.common import client, signup_and_login, started
+from main import app
+from posts.utils import db_like, db_post
+from users.utils import db_user
+
+
+async def cpu_per_call(call: Callable[[], Awaitable], calls: int) -> float:
+    """ Microseconds of process time per call. """
+    await call()
+    started_at = time.process_time()
+    for _ in range(calls):
+        await call()
+    return (time.process_time() - started_at) / calls * 1e6
+
+
+async def main(calls: int) -> None:
+    async with started(app), client(app) as session:
+        user = await signup_and_login(session)
+        response = await session.post(
+            "/api/posts/create",
+            json={"text": "statements"},
+            headers={"authorization": f"Bearer {user['access_token']}"},
+        )
+        post_id = response.json()["id"]
+        lookups = {
+            "user_by_id": lambda: db_user.user_by_id(user["id"]),
+            "post_by_id": lambda: db_post.post_by_id(post_id),
+            "author_by_id": lambda: db_post.author_by_id(post_id),
+            "reactions_count": lambda: db_like.count(post_id),
+            "GET /api/posts/{id}": lambda: session.get(f"/api/posts/{post_id}"),
+        }
+        for name, call in lookups.items():
+            print(f"{name} cpu_us={await cpu_per_call(call, calls):.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls))
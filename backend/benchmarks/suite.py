@@ -0,0 +1,303 @@
+"""
+The load test to compare commits: seeds a dataset from a random seed,
+runs the scenarios with many concurrent clients and writes throughput
+and p50/p95/p99 of every endpoint as JSON. Each endpoint is warmed up
+with requests that are not measured, login bursts are measured cold.
+
+Seeding empties the tables and flushes Redis, run it against a scratch
+database and Redis only. The app runs in this process, or pass --url of
+a server started on the same databases, with RATE_LIMIT=False:
+
+    python -m benchmarks.suite --users 1000 --posts 100000 --reactions 200000 \\
+        --output before.json
+    python -m benchmarks.suite ... --output after.json --baseline before.json
+
+The same seed gives the same users, posts and reactions, only the
+timestamps follow the time of seeding.
+"""
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import math
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+import httpx
+import sqlalchemy as sa
+from benchmarks.common import client, drive, report, started
+from db import connect, database, db_redis, disconnect, metadata
+from main import app
+from passlib.hash import bcrypt
+from users.utils import create_access_token
+
+""" Every seeded user has it, login bursts sign in with it. """
+PASSWORD = "bench-password"
+VOCABULARY = 20000
+""" Share of the reactions that go to the viral post, the newest one. """
+VIRAL_SHARE = 0.1
+
+RECOUNT = sa.text(
+    """
+    UPDATE posts SET like_count = counted.likes, dislike_count = counted.dislikes
+    FROM (
+        SELECT
+            post_id,
+            count(*) FILTER (WHERE value = 1) AS likes,
+            count(*) FILTER (WHERE value = -1) AS dislikes
+        FROM reactions GROUP BY post_id
+    ) AS counted
+    WHERE posts.id = counted.post_id
+    """
+)
+
+
+@dataclasses.dataclass
+class Dataset:
+    users: int
+    posts: int
+    reactions: int
+    seed: int
+    viral_post: int = 0
+    viral_author: int = 0
+    headers: list[dict] = dataclasses.field(default_factory=list)
+
+
+def _user(number: int) -> tuple:
+    name = f"user{number}"
+    return f"{name}@bench.bench", name, "bench", "bench"
+
+
+def _post_text(rng: random.Random) -> str:
+    return " ".join(
+        f"w{int(math.exp(rng.random() * math.log(VOCABULARY)))}" for _ in range(12)
+    )
+
+
+def _reactions(dataset: Dataset, rng: random.Random) -> tuple[list[tuple], list[int]]:
+    """
+    The authors of the posts and distinct (user, post, value) rows,
+    two likes to a dislike.
+    Most go to the newest posts, a tenth to the viral one.
+    Authors never react to their own posts, as the API does not allow it.
+    """
+    users, posts = dataset.users, dataset.posts
+    wanted = min(dataset.reactions, (users - 1) * posts)
+    viral = min(int(wanted * VIRAL_SHARE), users - 1)
+    authors = [rng.randint(1, users) for _ in range(posts)]
+    seen: set[tuple[int, int]] = set()
+    rows: list[tuple] = []
+    while len(rows) < wanted:
+        user_id = rng.randint(1, users)
+        if len(rows) < viral:
+            post_id = posts
+        else:
+            post_id = posts - int(posts * rng.random() ** 3)
+        if authors[post_id - 1] == user_id or (user_id, post_id) in seen:
+            continue
+        seen.add((user_id, post_id))
+        rows.append((user_id, post_id, 1 if rng.random() < 2 / 3 else -1))
+    return rows, authors
+
+
+async def seed(dataset: Dataset) -> None:
+    """ Empties the tables and fills them with COPY, ids start at 1. """
+    started_at = time.perf_counter()
+    rng = random.Random(dataset.seed)
+    reactions, authors = _reactions(dataset, rng)
+    password = bcrypt.hash(PASSWORD)
+    now = datetime.now(timezone.utc)
+    tables = ", ".join(metadata.tables)
+    async with database.connection() as connection:
+        raw = connection.raw_connection
+        await raw.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+        await raw.copy_records_to_table(
+            "users",
+            records=((*_user(n), password, now) for n in range(1, dataset.users + 1)),
+            columns=["email", "username", "first_name", "last_name", "password", "timestamp"],
+        )
+        await raw.copy_records_to_table(
+            "posts",
+            records=(
+                (_post_text(rng), author, now - timedelta(seconds=dataset.posts - number))
+                for number, author in enumerate(authors, 1)
+            ),
+            columns=["text", "author", "timestamp"],
+        )
+        await raw.execute("UPDATE posts SET search_vector = to_tsvector('simple', text)")
+        await raw.copy_records_to_table(
+            "reactions", records=reactions, columns=["user_id", "post_id", "value"]
+        )
+    await database.execute(RECOUNT)
+    await database.execute(sa.text("VACUUM ANALYZE"))
+    await db_redis.flushdb()
+    dataset.viral_post, dataset.viral_author = dataset.posts, authors[-1]
+    dataset.headers = [
+        {"authorization": f"Bearer {await create_access_token(user_id)}"}
+        for user_id in range(1, dataset.users + 1)
+    ]
+    print("seeded_s", round(time.perf_counter() - started_at, 1))
+
+
+Request = Callable[[int], Awaitable[httpx.Response]]
+
+
+def feed_paging(session: httpx.AsyncClient, dataset: Dataset, limit: int) -> dict[str, Request]:
+    """ Pages anywhere in the feed by number, and walks it by cursor from the top. """
+    rng = random.Random(dataset.seed)
+    pages = max(1, dataset.posts // limit)
+    cursors: dict[int, str] = {}
+
+    async def by_page(number: int) -> httpx.Response:
+        page = rng.randint(1, pages)
+        return await session.get("/api/posts/", params={"page": page, "limit": limit})
+
+    async def by_cursor(number: int) -> httpx.Response:
+        url = cursors.get(number) or f"/api/posts/?cursor=&limit={limit}"
+        response = await session.get(url)
+        if response.status_code == 200:
+            cursors[number] = response.json()["next"]
+        return response
+
+    return {"GET /api/posts/?page": by_page, "GET /api/posts/?cursor": by_cursor}
+
+
+def like_storm(session: httpx.AsyncClient, dataset: Dataset, limit: int) -> dict[str, Request]:
+    """
+    Every request likes the viral post as the next of the users, all but its author,
+    liking again takes it back.
+    """
+    headers = [
+        header for user_id, header in enumerate(dataset.headers, 1)
+        if user_id != dataset.viral_author
+    ]
+    sent = itertools.count()
+
+    async def like(number: int) -> httpx.Response:
+        return await session.post(
+            f"/api/posts/{dataset.viral_post}/like",
+            headers=headers[next(sent) % len(headers)],
+        )
+
+    return {"POST /api/posts/{post_id}/like": like}
+
+
+def login_burst(session: httpx.AsyncClient, dataset: Dataset, limit: int) -> dict[str, Request]:
+    rng = random.Random(dataset.seed)
+
+    async def login(number: int) -> httpx.Response:
+        username = f"user{rng.randint(1, dataset.users)}"
+        return await session.post(
+            "/api/auth/token/login", data={"username": username, "password": PASSWORD}
+        )
+
+    return {"POST /api/auth/token/login": login}
+
+
+def profile_reads(session: httpx.AsyncClient, dataset: Dataset, limit: int) -> dict[str, Request]:
+    """ Anyone's profile by id, and the own one with a token. """
+    rng = random.Random(dataset.seed)
+    headers = dataset.headers
+
+    async def profile(number: int) -> httpx.Response:
+        return await session.get(f"/api/users/{rng.randint(1, dataset.users)}")
+
+    async def me(number: int) -> httpx.Response:
+        return await session.get("/api/users/me", headers=headers[number % len(headers)])
+
+    return {"GET /api/users/{pk}": profile, "GET /api/users/me": me}
+
+
+SCENARIOS = {
+    "feed_paging": feed_paging,
+    "like_storm": like_storm,
+    "login_burst": login_burst,
+    "profile_reads": profile_reads,
+}
+
+
+def commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """ Prints the change of rps and p99 of every endpoint both runs have. """
+    for scenario, endpoints in results["scenarios"].items():
+        for endpoint, stats in endpoints.items():
+            before = baseline["scenarios"].get(scenario, {}).get(endpoint)
+            if not before:
+                continue
+            changes = " ".join(
+                f"{key}={before[key]}->{stats[key]} ({(stats[key] / before[key] - 1) * 100:+.1f}%)"
+                for key in ("rps", "p99_ms") if before[key]
+            )
+            print(f"{scenario} {endpoint} {changes}")
+
+
+async def run(args: argparse.Namespace, session: httpx.AsyncClient) -> dict:
+    dataset = Dataset(args.users, args.posts, args.reactions, args.seed)
+    await seed(dataset)
+    results: dict = {}
+    for name in args.scenarios.split(","):
+        total = args.logins if name == "login_burst" else args.requests
+        results[name] = {}
+        for endpoint, request in SCENARIOS[name](session, dataset, args.limit).items():
+            if name != "login_burst":
+                await drive(request, args.warmup, args.concurrency)
+            results[name][endpoint] = await drive(request, total, args.concurrency)
+            report(f"{name} {endpoint}", results[name][endpoint])
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "target": args.url or "in-process",
+        "dataset": dataclasses.asdict(dataset) | {"headers": len(dataset.headers)},
+        "concurrency": args.concurrency,
+        "warmup": args.warmup,
+        "scenarios": results,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    if args.url:
+        await connect(timeout=10)
+        try:
+            async with httpx.AsyncClient(base_url=args.url, timeout=60) as session:
+                results = await run(args, session)
+        finally:
+            await disconnect()
+    else:
+        async with started(app), client(app) as session:
+            results = await run(args, session)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--reactions", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,76 @@
+"""
+Throughput of the production server with 1, 2, 4 and 8 workers.
+
+Starts gunicorn with gunicorn.conf.py for every number of workers and
+reads a post and an uncached page of the feed over real sockets.
+The client runs on the same machine, give it cores of its own when
+measuring. Run from the backend folder with migrations applied:
+
+    python -m benchmarks.workers --workers 1,2,4,8 --requests 4000 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+
+import httpx
+from benchmarks.common import drive, report, signup_and_login
+
+BIND = "127.0.0.1:8765"
+
+
+async def ready(session: httpx.AsyncClient, server: subprocess.Popen) -> None:
+    while server.poll() is None:
+        try:
+            if (await session.get("/health/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("The server has exited")
+
+
+async def measure(workers: int, total: int, concurrency: int) -> None:
+    env = {**os.environ, "WEB_CONCURRENCY": str(workers), "BIND": BIND}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"], env=env
+    )
+    # Idle connections are dropped before the server's keepalive can close them.
+    limits = httpx.Limits(max_connections=concurrency, keepalive_expiry=1)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://{BIND}", limits=limits) as session:
+            await ready(session, server)
+            await asyncio.sleep(2)
+            user = await signup_and_login(session)
+            response = await session.post(
+                "/api/posts/create",
+                json={"text": "workers"},
+                headers={"authorization": f"Bearer {user['access_token']}"},
+            )
+            post_id = response.json()["id"]
+
+            async def read(number: int) -> httpx.Response:
+                if number % 2:
+                    return await session.get(f"/api/posts/{post_id}")
+                return await session.get("/api/posts/?page=9&total=estimate")
+
+            report(f"workers={workers}", await drive(read, total, concurrency))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+async def main(workers: list[int], total: int, concurrency: int) -> None:
+    for count in workers:
+        await measure(count, total, concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(main([int(i) for i in args.workers.split(",")], args.requests, args.concurrency))
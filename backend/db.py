@@ -1,12 +1,286 @@
+import asyncio
+import inspect
+import itertools
+import logging
+import random
+import time
+from contextvars import Context, ContextVar
+from functools import wraps
+from typing import Any, Callable, Coroutine
+
 import databases
 import sqlalchemy
-from settings import DATABASE_URL
+from asyncpg import CannotConnectNowError, PostgresError
+from metrics import TimedRedis, timed_query
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from settings import (DATABASE_URL, METRICS, POSTGRES_EXPORT_POOL_MAX,
+                      POSTGRES_POOL_MAX, POSTGRES_POOL_MIN, REDIS_POOL_MIN,
+                      REDIS_POOL_SIZE, REDIS_POOL_TIMEOUT, REDIS_URL,
+                      REPLICA_URLS, SLOW_QUERY_EXPLAIN, SLOW_QUERY_LOG_MAX,
+                      SLOW_QUERY_MS)
+from sqlalchemy.engine import Compiled
+from sqlalchemy.sql import ClauseElement
+
+logger = logging.getLogger(__name__)
+
+""" The model method running the statement, as Model.method. """
+current_method: ContextVar[str] = ContextVar("current_method", default="")
+
+
+class SlowQueryLog:
+    """
+    Logs statements slower than threshold seconds, at most limit a minute,
+    the ones past the limit are only counted. A share of them, explain,
+    comes with the plan, which is taken in the background.
+    """
+
+    FORMAT = "Slow query %s %.1f ms, %s more not logged\n%s\nparams: %r\n%s"
+
+    def __init__(self, threshold: float, limit: int, explain: float) -> None:
+        self.threshold = threshold
+        self.limit = limit
+        self.explain = explain
+        self.minute = 0.0
+        self.logged = 0
+        self.skipped = 0
+        self.tasks: set[asyncio.Task] = set()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if now - self.minute >= 60:
+            self.minute, self.logged = now, 0
+        if self.logged >= self.limit:
+            self.skipped += 1
+            return False
+        self.logged += 1
+        return True
+
+    def check(
+        self, database: databases.Database, query: Any, values: dict | None, elapsed: float
+    ) -> None:
+        if not self.threshold or elapsed < self.threshold or not self.allow():
+            return
+        sql, args, _ = database._backend.connection()._compile(  # type: ignore[attr-defined]
+            databases.core.Connection._build_query(query, values)
+        )
+        skipped, self.skipped = self.skipped, 0
+        fields = (current_method.get() or "-", elapsed * 1000, skipped, sql, args)
+        if random.random() >= self.explain:
+            logger.warning(self.FORMAT, *fields, "")
+            return
+        # an empty context, so the plan does not run on a connection of the caller
+        task = asyncio.create_task(
+            self.log_plan(database, sql, args, fields), context=Context()
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def log_plan(
+        self, database: databases.Database, sql: str, args: list, fields: tuple
+    ) -> None:
+        """ The caller does not wait for it, and its transaction is not touched. """
+        async with database.connection() as connection:
+            plan = await self.plan(connection, sql, args)
+        logger.warning(self.FORMAT, *fields, plan)
+
+    async def drain(self) -> None:
+        """ Waits for the plans being taken. """
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    @staticmethod
+    async def plan(connection: databases.core.Connection, sql: str, args: list) -> str:
+        """
+        ANALYZE runs the statement once more, so only SELECT gets the actual
+        times and buffers, a statement that may write gets the estimated plan.
+        """
+        explain = "EXPLAIN"
+        if sql.lstrip().upper().startswith("SELECT"):
+            explain = "EXPLAIN (ANALYZE, BUFFERS)"
+        try:
+            rows = await connection.raw_connection.fetch(f"{explain} {sql}", *args)
+        except PostgresError as error:
+            return f"{explain} failed: {error}"
+        return "\n".join(row[0] for row in rows)
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_MS / 1000, SLOW_QUERY_LOG_MAX, SLOW_QUERY_EXPLAIN)
+
+
+class Database(databases.Database):
+    """ Times every statement for the slow query log. """
+
+    async def fetch_all(self, query: Any, values: dict | None = None) -> list:
+        started_at = time.perf_counter()
+        rows = await super().fetch_all(query, values)
+        slow_query_log.check(self, query, values, time.perf_counter() - started_at)
+        return rows
+
+    async def fetch_one(self, query: Any, values: dict | None = None) -> Any:
+        started_at = time.perf_counter()
+        row = await super().fetch_one(query, values)
+        slow_query_log.check(self, query, values, time.perf_counter() - started_at)
+        return row
+
+    async def fetch_val(self, query: Any, values: dict | None = None, column: Any = 0) -> Any:
+        started_at = time.perf_counter()
+        value = await super().fetch_val(query, values, column)
+        slow_query_log.check(self, query, values, time.perf_counter() - started_at)
+        return value
+
+    async def execute(self, query: Any, values: dict | None = None) -> Any:
+        started_at = time.perf_counter()
+        result = await super().execute(query, values)
+        slow_query_log.check(self, query, values, time.perf_counter() - started_at)
+        return result
+
 
 metadata = sqlalchemy.MetaData()
-database = databases.Database(DATABASE_URL)
-engine = sqlalchemy.create_engine(DATABASE_URL)
+database = Database(
+    DATABASE_URL, min_size=POSTGRES_POOL_MIN, max_size=POSTGRES_POOL_MAX
+)
+replicas: list[databases.Database] = [
+    Database(url, min_size=POSTGRES_POOL_MIN, max_size=POSTGRES_POOL_MAX)
+    for url in REPLICA_URLS
+]
+""" For reads that stream for long, so they do not hold connections of the pools above. """
+exports = Database(
+    (REPLICA_URLS or [DATABASE_URL])[0], min_size=0, max_size=POSTGRES_EXPORT_POOL_MAX
+)
+""" Set for requests whose reads must see the latest writes. """
+primary_reads: ContextVar[bool] = ContextVar("primary_reads", default=False)
+redis_class = TimedRedis if METRICS else Redis
+db_redis: Redis = redis_class(connection_pool=BlockingConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_POOL_SIZE,
+    timeout=REDIS_POOL_TIMEOUT,
+    decode_responses=True,
+))
+
+
+async def connect(timeout: float) -> None:
+    """
+    Opens the Postgres pool with its minimum of connections and as many
+    Redis connections as REDIS_POOL_MIN, so the first requests do not pay
+    for them. Retries for timeout seconds while either is still coming up.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            for postgres in (database, *replicas, exports):
+                if not postgres.is_connected:
+                    await postgres.connect()
+            pool = db_redis.connection_pool
+            connections = []
+            try:
+                for _ in range(REDIS_POOL_MIN):
+                    connections.append(await pool.get_connection("PING"))
+            finally:
+                for connection in connections:
+                    await pool.release(connection)
+            return
+        except (OSError, CannotConnectNowError, RedisConnectionError) as error:
+            if time.monotonic() > deadline:
+                raise
+            logger.warning("Waiting for the databases: %s", error)
+            await asyncio.sleep(1)
+
+
+class CompiledQuery(ClauseElement):
+    """
+    A statement compiled once, with the values of this call.
+    databases compiles every query it runs, this one hands itself back.
+    """
+
+    def __init__(self, compiled: Compiled, values: dict) -> None:
+        self.string = compiled.string
+        self.values = {**compiled.params, **values}
+        self._bind_processors = compiled._bind_processors
+        self._result_columns = compiled._result_columns
+
+    @property
+    def params(self) -> dict:  # type: ignore[override]
+        return self.values
+
+    def compile(self, *args: Any, **kwargs: Any) -> "CompiledQuery":  # type: ignore[override]
+        return self
+
+
+async def disconnect() -> None:
+    await slow_query_log.drain()
+    for postgres in (database, *replicas, exports):
+        if postgres.is_connected:
+            await postgres.disconnect()
+    await db_redis.connection_pool.disconnect()
+
+
+def _named(name: str, method: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
+    if METRICS:
+        method = timed_query(name, method)
+
+    @wraps(method)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = current_method.set(name)
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            current_method.reset(token)
+    return wrapper
 
 
 class Base:
-    def __init__(self, database: databases.Database):
+    """ Compiled statements of all the models by name. """
+    compiled: dict[str, Compiled] = {}
+
+    def __init__(
+        self, database: databases.Database, replicas: list[databases.Database] | None = None
+    ):
         self.database = database
+        self.replicas = replicas if replicas is not None else []
+        self.next_replica = itertools.count()
+
+    def __init_subclass__(cls) -> None:
+        """ Every query method of a model goes by Model.method in the metrics and the logs. """
+        for name, method in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(method):
+                setattr(cls, name, _named(f"{cls.__name__}.{name}", method))
+
+    @property
+    def reader(self) -> databases.Database:
+        """
+        The replicas in turn for reads that may lag behind,
+        the primary when there are none or the request needs its writes.
+        """
+        if not self.replicas or primary_reads.get():
+            return self.database
+        return self.replicas[next(self.next_replica) % len(self.replicas)]
+
+    async def read_one(self, query: Any) -> Any:
+        """ A row the replica does not have yet is looked up on the primary. """
+        reader = self.reader
+        row = await reader.fetch_one(query)
+        if row is None and reader is not self.database:
+            row = await self.database.fetch_one(query)
+        return row
+
+    async def read_all(self, query: Any) -> list:
+        return await self.reader.fetch_all(query)
+
+    def prepared(self, name: str, build: Callable[[], ClauseElement], **values: Any) -> Any:
+        """
+        The statement from build compiled on the first call and reused,
+        values fill its bindparams. The SQL text stays the same,
+        so asyncpg keeps it prepared on every connection.
+        Only for statements whose SQL does not depend on the values.
+        """
+        key = f"{type(self).__name__}.{name}"
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            dialect = getattr(self.database._backend, "_dialect", None)
+            if dialect is None:
+                return build().params(**values)
+            compiled = build().compile(
+                dialect=dialect, compile_kwargs={"render_postcompile": True}
+            )
+            self.compiled[key] = compiled
+        return CompiledQuery(compiled, values)
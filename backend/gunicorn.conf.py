@@ -0,0 +1,73 @@
+"""
+Production server: gunicorn runs WEB_CONCURRENCY uvicorn workers.
+
+    gunicorn main:app -c gunicorn.conf.py
+
+kill -HUP reloads the code and the settings: new workers start and
+the old ones finish their requests within graceful_timeout.
+Workers import the app after the fork unless GUNICORN_PRELOAD=True.
+Either way nothing connects before the fork, every worker opens
+its own pools at startup, sized from the budgets in settings.py.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+from typing import Any
+
+""" Settings read the same number to split the connection budgets. """
+workers = int(os.getenv("WEB_CONCURRENCY", default=str(multiprocessing.cpu_count())))
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("BIND", default="0.0.0.0:8000")
+preload_app = os.getenv("GUNICORN_PRELOAD", default="False") == "True"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", default="30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", default="60"))
+keepalive = int(os.getenv("KEEPALIVE", default="5"))
+max_requests = int(os.getenv("MAX_REQUESTS", default="0"))
+max_requests_jitter = max_requests // 10
+accesslog = os.getenv("ACCESS_LOG", default=None)
+"""
+The client address is taken from X-Forwarded-For, which nginx sets.
+The port is published on localhost only, clients cannot set it themselves.
+"""
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", default="*")
+
+""" Workers write their metrics here for GET /metrics to add them up. """
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+
+
+def on_starting(server: Any) -> None:
+    """
+    Values left by a previous run are not counted.
+    Warns when the workers may open more connections than the budget.
+    """
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+    import settings
+    connections = workers * (settings.POSTGRES_POOL_MAX + settings.POSTGRES_EXPORT_POOL_MAX)
+    if connections > settings.POSTGRES_CONNECTIONS:
+        server.log.warning(
+            "%s workers may open %s connections to Postgres, POSTGRES_CONNECTIONS is %s",
+            workers, connections, settings.POSTGRES_CONNECTIONS,
+        )
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    """ The requests in flight of a worker that is gone are not counted. """
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server: Any, worker: Any) -> None:
+    """
+    A preloaded app has been imported in the master, sockets opened there
+    would be shared by all the workers. The Redis pool notices the new pid
+    and starts over by itself, the Postgres pool must not be open yet.
+    """
+    if preload_app:
+        from db import database
+        if database.is_connected:
+            raise RuntimeError("Postgres was connected before the fork")
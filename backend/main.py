@@ -1,35 +1,65 @@
+import asyncio
 from typing import Any
 
-from db import database, engine, metadata
+from db import connect, database, db_redis, disconnect
 from fastapi import FastAPI, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from metrics import latest
+from middleware import RateLimit, ReadYourWrites
 from posts import api_posts
+from posts.buffer import reaction_buffer
+from prometheus_client import CONTENT_TYPE_LATEST
+from settings import RATE_LIMITS, REACTIONS_WRITE_BEHIND, STARTUP_TIMEOUT
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from users import api_auth, api_users
 
 app = FastAPI()
 app.state.database = database
-metadata.create_all(engine)
+app.state.redis = db_redis
+app.state.ready = False
+app.add_middleware(ReadYourWrites)
+app.add_middleware(RateLimit, limits=RATE_LIMITS)
 
 
 @app.on_event("startup")
 async def startup() -> None:
-    database_ = app.state.database
-    if not database_.is_connected:
-        await database_.connect()
+    """ Nothing connects on import, the schema is managed by Alembic. """
+    await connect(STARTUP_TIMEOUT)
+    if REACTIONS_WRITE_BEHIND:
+        app.state.flusher = asyncio.create_task(reaction_buffer.run())
+    app.state.ready = True
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
-    database_ = app.state.database
-    if database_.is_connected:
-        await database_.disconnect()
+    app.state.ready = False
+    flusher = getattr(app.state, "flusher", None)
+    if flusher:
+        reaction_buffer.stop()
+        await flusher
+    await disconnect()
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def ready() -> JSONResponse:
+    """ 200 once the pools are open and warm, 503 while starting or stopping. """
+    if not app.state.ready:
+        return JSONResponse({"detail": "Not ready"}, status.HTTP_503_SERVICE_UNAVAILABLE)
+    return JSONResponse({"detail": "Ready"}, status.HTTP_200_OK)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """ For Prometheus to scrape, kept out of the metrics of the routes. """
+    return Response(latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Any, exc: Any) -> JSONResponse:
-    return JSONResponse({"detail": f"{exc.detail}"}, exc.status_code)
+    return JSONResponse(
+        {"detail": f"{exc.detail}"}, exc.status_code, getattr(exc, "headers", None)
+    )
 
 
 @app.exception_handler(RequestValidationError)
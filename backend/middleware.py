@@ -0,0 +1,128 @@
+import math
+
+import settings
+from db import db_redis, primary_reads, replicas
+from fastapi import status
+from fastapi.responses import JSONResponse
+from jose import JWTError, jwt
+from starlette.routing import compile_path
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+"""
+KEYS: the bucket. ARGV: requests a second, the burst.
+Refills the bucket for the time since the last request and takes one
+token from it. Returns 1, or 0 and the seconds until there is a token.
+"""
+TOKEN_BUCKET = db_redis.register_script(
+    """
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+    local tokens = tonumber(bucket[1]) or burst
+    tokens = math.min(burst, tokens + (now - (tonumber(bucket[2]) or now)) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    if wait > 0 then
+        return {0, tostring(wait)}
+    end
+    return {1}
+    """
+)
+
+
+def bearer_user(scope: Scope) -> str | None:
+    """ The user id of a valid access token, None without one. """
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer":
+                return None
+            try:
+                payload = jwt.decode(
+                    token, settings.JWT_SECRET_KEY, algorithms=[settings.ALGORITHM]
+                )
+            except JWTError:
+                return None
+            return payload.get("sub")
+    return None
+
+
+class ReadYourWrites:
+    """
+    Requests that write read from the primary, and so does a user for
+    READ_YOUR_WRITES seconds after a write of theirs has succeeded,
+    in every worker. Does nothing without replicas.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not replicas:
+            return await self.app(scope, receive, send)
+        user_id = bearer_user(scope)
+        if scope["method"] in SAFE_METHODS:
+            if not user_id or not await db_redis.exists(f"wrote={user_id}"):
+                return await self.app(scope, receive, send)
+            token = primary_reads.set(True)
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                primary_reads.reset(token)
+
+        async def send_wrote(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                await db_redis.set(f"wrote={user_id}", 1, ex=settings.READ_YOUR_WRITES)
+            await send(message)
+
+        token = primary_reads.set(True)
+        try:
+            await self.app(scope, receive, send_wrote if user_id else send)
+        finally:
+            primary_reads.reset(token)
+
+
+class RateLimit:
+    """
+    A token bucket in Redis for every route in limits and every user or host,
+    one round trip for a limited request and none for the others.
+    A request that finds its bucket empty gets 429 with Retry-After.
+    """
+
+    def __init__(self, app: ASGIApp, limits: dict[str, tuple[float, int, str]]) -> None:
+        self.app = app
+        self.limits = self.compile(limits)
+
+    @staticmethod
+    def compile(limits: dict[str, tuple[float, int, str]]) -> list[tuple]:
+        routes = []
+        for route, (rate, burst, key) in limits.items():
+            method, path = route.split(" ", 1)
+            routes.append((method, compile_path(path)[0], route, rate, burst, key))
+        return routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            for method, regex, route, rate, burst, key in self.limits:
+                if scope["method"] == method and regex.match(scope["path"]):
+                    user_id = bearer_user(scope) if key == "user" else None
+                    who = f"user={user_id}" if user_id else f"host={(scope['client'] or '-')[0]}"
+                    allowed = await TOKEN_BUCKET([f"rate:{route}:{who}"], [rate, burst])
+                    if not allowed[0]:
+                        response = JSONResponse(
+                            {"detail": "Too many requests"},
+                            status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={"Retry-After": str(math.ceil(float(allowed[1])))},
+                        )
+                        return await response(scope, receive, send)
+                    break
+        await self.app(scope, receive, send)
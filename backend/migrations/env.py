@@ -1,7 +1,8 @@
 from logging.config import fileConfig
 
 from alembic import context
-from main import metadata
+import main  # noqa: F401, the routers import every model
+from db import metadata
 from settings import DATABASE_URL
 from sqlalchemy import engine_from_config, pool
 
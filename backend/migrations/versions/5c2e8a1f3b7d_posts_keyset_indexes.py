@@ -0,0 +1,30 @@
+"""Posts keyset indexes
+
+Revision ID: 5c2e8a1f3b7d
+Revises: 011bd691776d
+Create Date: 2026-10-18 15:30:12.418207
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '5c2e8a1f3b7d'
+down_revision = '011bd691776d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_posts_timestamp_id', 'posts',
+        [sa.text('"timestamp" DESC'), sa.text('id DESC')],
+    )
+    op.create_index(
+        'ix_posts_author_timestamp_id', 'posts',
+        ['author', sa.text('"timestamp" DESC'), sa.text('id DESC')],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_author_timestamp_id', table_name='posts')
+    op.drop_index('ix_posts_timestamp_id', table_name='posts')
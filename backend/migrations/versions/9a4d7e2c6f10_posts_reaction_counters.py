@@ -0,0 +1,35 @@
+"""Posts reaction counters
+
+Revision ID: 9a4d7e2c6f10
+Revises: 5c2e8a1f3b7d
+Create Date: 2026-10-18 16:05:47.902114
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '9a4d7e2c6f10'
+down_revision = '5c2e8a1f3b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column(
+        'like_count', sa.Integer(), server_default='0', nullable=False
+    ))
+    op.add_column('posts', sa.Column(
+        'dislike_count', sa.Integer(), server_default='0', nullable=False
+    ))
+    op.execute(
+        """
+        UPDATE posts SET
+            like_count = (SELECT count(*) FROM likes WHERE likes.post_id = posts.id),
+            dislike_count = (SELECT count(*) FROM dislikes WHERE dislikes.post_id = posts.id)
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'dislike_count')
+    op.drop_column('posts', 'like_count')
@@ -0,0 +1,90 @@
+"""Unified reactions
+
+Revision ID: c3f81b6d2a94
+Revises: 9a4d7e2c6f10
+Create Date: 2026-10-18 16:48:03.551270
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'c3f81b6d2a94'
+down_revision = '9a4d7e2c6f10'
+branch_labels = None
+depends_on = None
+
+RECOUNT = """
+    UPDATE posts SET
+        like_count = (
+            SELECT count(*) FROM reactions
+            WHERE reactions.post_id = posts.id AND reactions.value = 1
+        ),
+        dislike_count = (
+            SELECT count(*) FROM reactions
+            WHERE reactions.post_id = posts.id AND reactions.value = -1
+        )
+"""
+
+
+def upgrade() -> None:
+    op.create_table('reactions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.SmallInteger(), nullable=False),
+    sa.CheckConstraint('value IN (-1, 1)', name='reaction_value'),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_reactions_post_id', 'reactions', ['post_id'])
+    # A user found in both tables keeps the like.
+    op.execute(
+        """
+        INSERT INTO reactions (user_id, post_id, value)
+        SELECT user_id, post_id, 1 FROM likes
+        WHERE user_id IS NOT NULL AND post_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO reactions (user_id, post_id, value)
+        SELECT user_id, post_id, -1 FROM dislikes
+        WHERE user_id IS NOT NULL AND post_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+        """
+    )
+    op.execute(RECOUNT)
+    op.drop_table('likes')
+    op.drop_table('dislikes')
+
+
+def downgrade() -> None:
+    op.create_table('dislikes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'post_id', name='unique_for_dislikes')
+    )
+    op.create_table('likes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'post_id', name='unique_for_like')
+    )
+    op.execute(
+        "INSERT INTO likes (user_id, post_id) "
+        "SELECT user_id, post_id FROM reactions WHERE value = 1"
+    )
+    op.execute(
+        "INSERT INTO dislikes (user_id, post_id) "
+        "SELECT user_id, post_id FROM reactions WHERE value = -1"
+    )
+    op.drop_index('ix_reactions_post_id', table_name='reactions')
+    op.drop_table('reactions')
@@ -0,0 +1,37 @@
+"""Follows
+
+Revision ID: e7b2d94a1c58
+Revises: c3f81b6d2a94
+Create Date: 2026-10-18 17:41:26.308815
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = 'e7b2d94a1c58'
+down_revision = 'c3f81b6d2a94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column(
+        'followers_count', sa.Integer(), server_default='0', nullable=False
+    ))
+    op.create_table('follows',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column(
+        'timestamp', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True
+    ),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['follower_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('follower_id', 'author_id')
+    )
+    op.create_index(op.f('ix_follows_author_id'), 'follows', ['author_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_follows_author_id'), table_name='follows')
+    op.drop_table('follows')
+    op.drop_column('users', 'followers_count')
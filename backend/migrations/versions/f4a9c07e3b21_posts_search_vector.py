@@ -0,0 +1,28 @@
+"""Posts search vector
+
+Revision ID: f4a9c07e3b21
+Revises: e7b2d94a1c58
+Create Date: 2026-10-18 18:12:09.417730
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision = 'f4a9c07e3b21'
+down_revision = 'e7b2d94a1c58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+    op.execute("UPDATE posts SET search_vector = to_tsvector('simple', coalesce(text, ''))")
+    op.create_index(
+        'ix_posts_search_vector', 'posts', ['search_vector'], postgresql_using='gin'
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
@@ -1,63 +1,162 @@
-from typing import Any
-
-from db import database
-from fastapi import APIRouter, Depends, Query, status
-from fastapi.responses import JSONResponse
-from posts.models import LikeDislike, Post
-from posts.schemas import PostBase, PostCreate, PostDetail, PostLike, PostList
-from posts.utils import check_author, query_list
-from redis import Redis
-from settings import NOT_FOUND, REDIS_URL
+from typing import Any, Literal
+
+from db import database, replicas
+from fastapi import APIRouter, BackgroundTasks, Depends, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from metrics import TimedRoute
+from posts.cache import FeedPage, PostCache, bump_feed, drop_post
+from posts.importer import FORMATS, import_posts
+from posts.models import Post
+from posts.schemas import (PostBase, PostCreate, PostDetail, PostImportResult,
+                           PostLike, PostList, PostReactions)
+from posts.serializers import (dump_list, ndjson_lines, post_list_response,
+                               post_response)
+from posts.utils import (ID_MAX, check_author, decode_search_cursor, fan_out,
+                         feed_page, query_list, reactions_by_ids, search_list,
+                         timeline_page)
+from settings import (FEED_CACHE_PAGES, NOT_FOUND, POSTS_PAGE_MAX,
+                      REACTIONS_BATCH_MAX)
 from starlette.requests import Request
 from users.schemas import UserOut
 from users.utils import get_current_user
 
-router = APIRouter(prefix='/posts', tags=["posts"])
-db_post = Post(database)
-db_like = LikeDislike(database)
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
+router = APIRouter(prefix='/posts', tags=["posts"], route_class=TimedRoute)
+db_post = Post(database, replicas)
 PROTECTED = Depends(get_current_user)
+""" Pages with other query parameters are not cached, their links would keep them. """
+FEED_PARAMS = {"page", "limit", "author", "cursor", "total"}
 
 
 @router.get("/", response_model=PostList, status_code=status.HTTP_200_OK)
 async def get_posts(
     request: Request,
     page: int = Query(1, ge=1),
-    limit: int = Query(6, ge=1),
-    author: int | None = Query(None)
-) -> dict:
+    limit: int = Query(6, ge=1, le=POSTS_PAGE_MAX),
+    author: int | None = Query(None),
+    cursor: str | None = Query(None),
+    total: Literal["exact", "estimate", "none"] = Query("exact"),
+) -> Any:
     """
     Viewing all posts is available to everyone.
     Implemented pagination and filtering by author.
+    Pass an empty cursor to switch to keyset pagination,
+    then follow the next and previous links.
+    total=estimate gives an approximate count,
+    total=none skips it and only tells if there is a next page.
+    The first pages and the top of the keyset pagination are cached
+    with an ETag, send it in If-None-Match.
     """
-    query = await db_post.posts_all(page, limit, author)
-    count = await db_post.posts_count(author)
-    return await query_list(query, request, count[0], page, limit)
+    if page > FEED_CACHE_PAGES or cursor or not FEED_PARAMS.issuperset(request.query_params):
+        return post_list_response(await feed_page(request, page, limit, author, cursor, total))
+    cache = FeedPage(request, author, page if cursor is None else "cursor", limit, total)
+    if cached := await cache.cached():
+        return cached
+    return await cache.load(
+        lambda: feed_page(request, page, limit, author, cursor, total), dump_list
+    )
 
 
 @router.post("/create", response_model=PostBase, status_code=status.HTTP_201_CREATED)
-async def create_post(post_items: PostCreate, user: UserOut = PROTECTED) -> PostBase:
-    """ Only registered users can post. """
+async def create_post(
+    post_items: PostCreate, background_tasks: BackgroundTasks, user: UserOut = PROTECTED
+) -> PostBase:
+    """
+    Only registered users can post.
+    The post reaches the followers' timelines after the response.
+    """
     post_dict = dict(post_items)
     post_dict["author"] = user.id
-    return await db_post.create(post_dict)
+    post = await db_post.create(post_dict)
+    await bump_feed(user.id)
+    background_tasks.add_task(fan_out, post)
+    return post
 
 
-@router.get("/{post_id}", response_model=PostDetail, status_code=status.HTTP_200_OK)
-async def get_post(post_id: int) -> Any:
-    """ The post is available to everyone. """
-    query = await db_post.post_by_id(post_id)
-    if not query:
-        return NOT_FOUND
-    query_dict = dict(query)
-    like_redis: dict = db_redis.hgetall(f"id={post_id}")
+@router.post("/import", response_model=PostImportResult, status_code=status.HTTP_200_OK)
+async def bulk_import(request: Request, user: UserOut = PROTECTED) -> Any:
+    """
+    Posts of the user from an NDJSON or CSV body, by its Content-Type,
+    each with text and an optional timestamp. The body is imported
+    while it arrives, the rows that fail are reported by line.
+    Imported posts reach the timelines when those are rebuilt.
+    """
+    format = FORMATS.get(request.headers.get("content-type", "").split(";")[0].strip())
+    if format is None:
+        return JSONResponse(
+            {"detail": f"Content-Type must be one of {', '.join(FORMATS)}"},
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        )
+    return await import_posts(request.stream(), format, user.id, only_author=True)
+
+
+@router.get("/timeline", response_model=PostList, status_code=status.HTTP_200_OK)
+async def get_timeline(
+    request: Request,
+    page: int = Query(1, ge=1),
+    limit: int = Query(6, ge=1, le=POSTS_PAGE_MAX),
+    user: UserOut = PROTECTED,
+) -> Any:
+    """ Posts of the user and of the authors they follow, newest first. """
+    query = await timeline_page(user.id, page, limit)
+    return post_list_response(await query_list(query, request, None, page, limit))
+
+
+@router.get("/search", response_model=PostList, status_code=status.HTTP_200_OK)
+async def search_posts(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(6, ge=1, le=POSTS_PAGE_MAX),
+    cursor: str | None = Query(None),
+) -> Any:
+    """
+    Full-text search over the post text, best matches first.
+    Quoted phrases, or and -word work as in web search.
+    """
+    position = decode_search_cursor(cursor) if cursor else None
+    query = await db_post.search(q, limit, position)
+    return post_list_response(await search_list(query, request, limit))
+
+
+@router.get("/export", response_class=StreamingResponse, status_code=status.HTTP_200_OK)
+async def export_posts(author: int | None = Query(None)) -> StreamingResponse:
+    """
+    All posts, or the posts of an author, newest first as NDJSON,
+    one post per line. They are read through a server-side cursor
+    and sent as they come, so any number of posts takes the same memory.
+    """
+    return StreamingResponse(
+        ndjson_lines(db_post.export(author)), media_type="application/x-ndjson"
+    )
+
+
+@router.get("/reactions", response_model=list[PostReactions], status_code=status.HTTP_200_OK)
+async def get_reactions(ids: str = Query(..., regex=r"^\d+(,\d+)*$")) -> Any:
+    """
+    Likes and dislikes of several posts, ids are separated by commas.
+    Posts that do not exist are left out.
+    """
+    post_ids = list(dict.fromkeys(int(i) for i in ids.split(",")))
+    if max(post_ids) > ID_MAX:
+        return JSONResponse({"detail": "No such ids"}, status.HTTP_400_BAD_REQUEST)
+    if len(post_ids) > REACTIONS_BATCH_MAX:
+        return JSONResponse(
+            {"detail": f"No more than {REACTIONS_BATCH_MAX} ids"},
+            status.HTTP_400_BAD_REQUEST,
+        )
+    return await reactions_by_ids(post_ids)
 
-    if not like_redis:
-        like_redis = dict(await db_like.count(post_id))
-        db_redis.hmset(f"id={post_id}", like_redis)
 
-    query_dict.update(like_redis)
-    return query_dict
+@router.get("/{post_id}", response_model=PostDetail, status_code=status.HTTP_200_OK)
+async def get_post(post_id: int) -> Any:
+    """
+    The post is available to everyone.
+    While it is cached, it is read from Redis only.
+    """
+    cache = PostCache(post_id)
+    if post := await cache.cached():
+        return post_response(post)
+    post = await cache.load(lambda: db_post.post_by_id(post_id))
+    return post_response(post) if post else NOT_FOUND
 
 
 @router.put("/{post_id}", response_model=PostBase, status_code=status.HTTP_200_OK)
@@ -69,6 +168,8 @@ async def update_post(post_id: int, post_items: PostCreate, user: UserOut = PROT
             {"detail": "Only the author can edit or the post does not exist"},
             status.HTTP_403_FORBIDDEN,
         )
+    await drop_post(post_id)
+    await bump_feed(user.id)
     return post
 
 
@@ -80,6 +181,8 @@ async def delete_post(post_id: int, user: UserOut = PROTECTED) -> Any:
             {"detail": "Only the author can delete or has already deleted"},
             status.HTTP_403_FORBIDDEN,
         )
+    await drop_post(post_id, deleted=True)
+    await bump_feed(user.id)
     return JSONResponse({"detail": "Removed"}, status.HTTP_404_NOT_FOUND)
 
 
@@ -0,0 +1,180 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+
+from db import database, db_redis
+from posts.cache import bump_feed
+from posts.models import LikeDislike
+from redis.exceptions import ResponseError
+from settings import (REACTIONS_FLUSH_BATCH, REACTIONS_FLUSH_INTERVAL,
+                      REACTIONS_STATE_TTL)
+
+logger = logging.getLogger(__name__)
+
+REACTIONS_LOG = "reactions:log"
+REACTIONS_GROUP = "flusher"
+
+"""
+KEYS: post counters, reactions of the post by user, journal.
+ARGV: post_id, user_id, value, ttl and, after a miss, the author,
+like, dislike and the user's reaction read from Postgres.
+Returns author, like and dislike or false if something has to be read first.
+"""
+REACTION_TOGGLE = """
+local counters, state, log = KEYS[1], KEYS[2], KEYS[3]
+local post, user, value, ttl = ARGV[1], ARGV[2], tonumber(ARGV[3]), ARGV[4]
+local field = 'user:' .. user
+if ARGV[5] then
+    redis.call('HSETNX', state, 'author', ARGV[5])
+    redis.call('HSETNX', counters, 'like', ARGV[6])
+    redis.call('HSETNX', counters, 'dislike', ARGV[7])
+    redis.call('HSETNX', state, field, ARGV[8])
+end
+local author = redis.call('HGET', state, 'author')
+local old = redis.call('HGET', state, field)
+local like = redis.call('HGET', counters, 'like')
+local dislike = redis.call('HGET', counters, 'dislike')
+if not (author and old and like and dislike) then
+    return false
+end
+if author ~= user then
+    old = tonumber(old)
+    local new = value
+    if old == value then
+        new = 0
+    end
+    like = redis.call(
+        'HINCRBY', counters, 'like', (new == 1 and 1 or 0) - (old == 1 and 1 or 0)
+    )
+    dislike = redis.call(
+        'HINCRBY', counters, 'dislike', (new == -1 and 1 or 0) - (old == -1 and 1 or 0)
+    )
+    redis.call('HSET', state, field, new)
+    redis.call('EXPIRE', state, ttl)
+    redis.call('EXPIRE', counters, ttl)
+    redis.call('XADD', log, '*', 'post', post, 'user', user, 'value', new)
+end
+return {author, like, dislike}
+"""
+
+
+class ReactionBuffer:
+    """
+    Write-behind for likes and dislikes.
+    A toggle changes the reaction and the counters in Redis and appends
+    the change to a stream, the flusher reads the stream in a consumer group
+    and writes the latest reactions to Postgres before acknowledging them.
+    Entries a stopped worker has read but not acknowledged are claimed
+    by another flusher once they have been idle for claim_idle milliseconds.
+    """
+
+    def __init__(self) -> None:
+        self.db_like = LikeDislike(database)
+        self.script = db_redis.register_script(REACTION_TOGGLE)
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_idle = int(REACTIONS_FLUSH_INTERVAL * 10_000)
+        self.stopped = asyncio.Event()
+
+    async def toggle(self, post_id: int, user_id: int, like: bool = False) -> dict | None:
+        """
+        The same as LikeDislike.like in one round trip to Redis,
+        a post or user seen for the first time is read from Postgres once.
+        """
+        keys = [f"id={post_id}", f"reactions={post_id}", REACTIONS_LOG]
+        args = [post_id, user_id, 1 if like else -1, REACTIONS_STATE_TTL]
+        result = await self.script(keys, args)
+        if result is None:
+            record = await self.db_like.state(post_id, user_id)
+            if not record:
+                return None
+            result = await self.script(
+                keys, [*args, record["author"], record["like"], record["dislike"], record["value"]]
+            )
+        author, like_count, dislike_count = (int(i) for i in result)
+        return {"author": author, "like": like_count, "dislike": dislike_count}
+
+    async def create_group(self) -> None:
+        try:
+            await db_redis.xgroup_create(REACTIONS_LOG, REACTIONS_GROUP, id="0", mkstream=True)
+        except ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    async def read(self, start: str) -> list:
+        """ Pending entries of this worker from 0, new ones from >. """
+        read = await db_redis.xreadgroup(
+            REACTIONS_GROUP, self.consumer, {REACTIONS_LOG: start},
+            count=REACTIONS_FLUSH_BATCH,
+        )
+        return [(entry_id, fields) for entry_id, fields in read[0][1] if fields] if read else []
+
+    async def flush(self) -> int:
+        """
+        Writes one batch of the journal to Postgres and acknowledges it,
+        returns the number of entries. Entries of a failed or interrupted
+        batch of this worker go first, then those abandoned by others.
+        The reaction currently in Redis is written rather than the one
+        in the entry, so an old entry replayed late cannot undo a newer one.
+        """
+        entries = await self.read("0")
+        if not entries:
+            claimed = await db_redis.xautoclaim(
+                REACTIONS_LOG, REACTIONS_GROUP, self.consumer,
+                self.claim_idle, count=REACTIONS_FLUSH_BATCH,
+            )
+            entries = [(entry_id, fields) for entry_id, fields in claimed[1] if fields]
+        if not entries:
+            entries = await self.read(">")
+        if not entries:
+            return 0
+
+        latest = {
+            (int(fields["post"]), int(fields["user"])): int(fields["value"])
+            for _, fields in entries
+        }
+        pairs = sorted(latest)
+        async with db_redis.pipeline(transaction=False) as pipe:
+            for post_id, user_id in pairs:
+                pipe.hget(f"reactions={post_id}", f"user:{user_id}")
+            current = await pipe.execute()
+        authors = await self.db_like.apply([
+            (post_id, user_id, latest[post_id, user_id] if value is None else int(value))
+            for (post_id, user_id), value in zip(pairs, current)
+        ])
+        await bump_feed(*authors)
+
+        ids = [entry_id for entry_id, _ in entries]
+        async with db_redis.pipeline(transaction=False) as pipe:
+            pipe.xack(REACTIONS_LOG, REACTIONS_GROUP, *ids)
+            pipe.xdel(REACTIONS_LOG, *ids)
+            await pipe.execute()
+        return len(entries)
+
+    async def run(self) -> None:
+        """
+        Flushes until stop is called, full batches follow each other
+        without a pause. A batch is never cancelled halfway, an interrupted
+        transaction would keep its connection out of the pool.
+        """
+        self.stopped = asyncio.Event()
+        await self.create_group()
+        while not self.stopped.is_set():
+            try:
+                flushed = await self.flush()
+            except Exception:
+                logger.exception("Reactions flush failed, the batch is retried")
+                flushed = 0
+            if flushed < REACTIONS_FLUSH_BATCH:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.stopped.wait(), REACTIONS_FLUSH_INTERVAL)
+        while await self.flush() >= REACTIONS_FLUSH_BATCH:
+            pass
+
+    def stop(self) -> None:
+        """ Asks run to write what is left and return. """
+        self.stopped.set()
+
+
+reaction_buffer = ReactionBuffer()
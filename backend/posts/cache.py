@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable
+
+import orjson
+from db import db_redis, primary_reads
+from metrics import cache_result
+from posts.schemas import PostBase
+from redis.asyncio.client import Pipeline
+from settings import FEED_CACHE_TTL, POST_CACHE_TTL
+from starlette.requests import Request
+from starlette.responses import Response
+
+"""
+KEYS: the generation of the feed.
+ARGV: the page key, If-None-Match of the request.
+Returns the generation, then the ETag if the client has this page,
+or the ETag and the body if it is cached.
+"""
+FEED_CACHE_GET = db_redis.register_script(
+    """
+    local generation = redis.call('GET', KEYS[1]) or '0'
+    local key = 'feed:' .. generation .. ':' .. ARGV[1]
+    local etag = redis.call('HGET', key, 'etag')
+    if not etag then
+        return {generation}
+    end
+    if etag == ARGV[2] then
+        return {generation, etag}
+    end
+    return {generation, etag, redis.call('HGET', key, 'body')}
+    """
+)
+
+""" The fields of a post cached apart from its counters. """
+POST_CACHE_FIELDS = tuple(PostBase.__fields__)
+
+"""
+KEYS: the cached post.
+ARGV: the version read before the query, the post, the TTL.
+Caches the post only if no write has bumped the version since.
+"""
+POST_CACHE_SET = db_redis.register_script(
+    """
+    if (redis.call('HGET', KEYS[1], 'version') or '0') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'version', ARGV[1], 'body', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+    """
+)
+
+"""
+KEYS: the counters of a post.
+ARGV: like, dislike, the TTL.
+Caches counters read from Postgres only if none are cached,
+a reaction may have set newer ones since the query.
+"""
+COUNTERS_FILL = db_redis.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        redis.call('HSET', KEYS[1], 'like', ARGV[1], 'dislike', ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+    end
+    """
+)
+
+"""
+KEYS: the counters of a post.
+ARGV: like, dislike, the stamp of the write, the TTL.
+Reactions to a post commit one after another with growing stamps,
+counters of an earlier one never replace those of a later one.
+"""
+COUNTERS_SET = db_redis.register_script(
+    """
+    if tonumber(redis.call('HGET', KEYS[1], 'stamp') or '0') >= tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'like', ARGV[1], 'dislike', ARGV[2], 'stamp', ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+    """
+)
+
+
+def _generation_key(author: int | None) -> str:
+    return f"feed:gen:author={author}" if author else "feed:gen"
+
+
+def _response(body: bytes | str | None, etag: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if body is None:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+class FeedPage:
+    """
+    A page of GET /api/posts cached under the generation of its feed,
+    the whole feed or one author's posts. Any change bumps the generation,
+    so pages of the old one are never read again and expire on their own.
+    """
+
+    building: dict[str, asyncio.Future] = {}
+
+    def __init__(
+        self, request: Request, author: int | None, page: int | str, limit: int, total: str
+    ) -> None:
+        self.generation_key = _generation_key(author)
+        self.key = f"{author}:{page}:{limit}:{total}"
+        self.if_none_match = request.headers.get("if-none-match", "")
+        self.generation = "0"
+
+    async def cached(self) -> Response | None:
+        """ 304 or the cached page in one round trip, None on a miss. """
+        result = await FEED_CACHE_GET([self.generation_key], [self.key, self.if_none_match])
+        self.generation = result[0]
+        cache_result("feed", len(result) > 1)
+        if len(result) == 1:
+            return None
+        return _response(result[2] if len(result) == 3 else None, result[1])
+
+    async def load(
+        self, build: Callable[[], Awaitable[dict]], dumps: Callable[[dict], bytes]
+    ) -> Response:
+        """
+        Builds the page after a miss, once per process however many
+        requests missed it together, and caches it.
+        """
+        key = f"feed:{self.generation}:{self.key}"
+        future = self.building.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.store(key, build, dumps))
+            self.building[key] = future
+            future.add_done_callback(lambda _: self.building.pop(key, None))
+        body, etag = await asyncio.shield(future)
+        return _response(None if etag == self.if_none_match else body, etag)
+
+    @staticmethod
+    async def store(
+        key: str, build: Callable[[], Awaitable[dict]], dumps: Callable[[dict], bytes]
+    ) -> tuple[bytes, str]:
+        """
+        Caches the serialized page under the generation read before the query,
+        a write in between has bumped it already and nobody reads this one.
+        The page is read from the primary, a replica behind the generation
+        would leave a stale page under it.
+        """
+        primary_reads.set(True)
+        body = dumps(await build())
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        async with db_redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={"etag": etag, "body": body})
+            pipe.expire(key, FEED_CACHE_TTL)
+            await pipe.execute()
+        return body, etag
+
+
+async def bump_feed(*authors: int) -> None:
+    """ Called after a post or its reactions change in Postgres. """
+    async with db_redis.pipeline(transaction=False) as pipe:
+        pipe.incr(_generation_key(None))
+        for author in set(authors):
+            pipe.incr(_generation_key(author))
+        await pipe.execute()
+
+
+async def cache_counters(post_id: int, like: int, dislike: int, stamp: int) -> None:
+    """ The counters of a post after a reaction, they expire with the post. """
+    await COUNTERS_SET([f"id={post_id}"], [like, dislike, stamp, POST_CACHE_TTL])
+
+
+async def fill_counters(pipe: Pipeline, post_id: int, like: int, dislike: int) -> None:
+    """ The same for counters read from Postgres, they never replace cached ones. """
+    await COUNTERS_FILL([f"id={post_id}"], [like, dislike, POST_CACHE_TTL], client=pipe)
+
+
+class PostCache:
+    """
+    A post without its counters, cached under post={id} with its version.
+    Writes bump the version and drop the post, so a read that queried
+    before the write cannot cache the old post over it.
+    The counters stay in id={id}, where reactions keep them up to date.
+    """
+
+    def __init__(self, post_id: int) -> None:
+        self.post_id = post_id
+        self.key = f"post={post_id}"
+        self.version = "0"
+        self.post: dict | None = None
+        self.counters: dict = {}
+
+    async def cached(self) -> dict | None:
+        """ The post with its counters in one round trip, None if either is missing. """
+        async with db_redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.key, "version", "body")
+            pipe.hgetall(f"id={self.post_id}")
+            (version, body), counters = await pipe.execute()
+        self.version = version or "0"
+        cache_result("post", body is not None)
+        cache_result("reactions", bool(counters))
+        if body is not None:
+            self.post = orjson.loads(body)
+        self.counters = {key: int(counters[key]) for key in ("like", "dislike") if key in counters}
+        if self.post is None or not self.counters:
+            return None
+        return {**self.post, **self.counters}
+
+    async def load(self, build: Callable[[], Awaitable[Any]]) -> dict | None:
+        """
+        Queries the post after a miss and caches what was missing.
+        The post is read from the primary, a replica behind the version
+        would leave a stale post under it. The counters are cached only if
+        no reaction has set them since. None if there is no such post.
+        """
+        primary_reads.set(True)
+        row = await build()
+        if row is None:
+            return None
+        async with db_redis.pipeline(transaction=False) as pipe:
+            if self.post is None:
+                self.post = {name: row[name] for name in POST_CACHE_FIELDS}
+                await POST_CACHE_SET(
+                    [self.key], [self.version, orjson.dumps(self.post), POST_CACHE_TTL],
+                    client=pipe,
+                )
+            if not self.counters:
+                self.counters = {"like": row["like"], "dislike": row["dislike"]}
+                await fill_counters(pipe, self.post_id, **self.counters)
+            await pipe.execute()
+        return {**self.post, **self.counters}
+
+
+async def drop_post(post_id: int, deleted: bool = False) -> None:
+    """
+    Called after a post changes in Postgres. A deleted post also loses its
+    counters and reactions, only its version is left until it expires.
+    """
+    key = f"post={post_id}"
+    async with db_redis.pipeline(transaction=True) as pipe:
+        pipe.hincrby(key, "version", 1)
+        pipe.hdel(key, "body")
+        pipe.expire(key, POST_CACHE_TTL)
+        if deleted:
+            pipe.delete(f"id={post_id}", f"reactions={post_id}")
+        await pipe.execute()
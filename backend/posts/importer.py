@@ -0,0 +1,205 @@
+"""
+Bulk import of posts from NDJSON or CSV. The input is read as a stream
+and written with binary COPY in batches, so the memory it takes does not
+grow with its size. Each line of NDJSON, or row of CSV after the header,
+is a post with text, and optionally timestamp and author.
+
+From a file, for any authors, with the databases of the settings:
+
+    python -m posts.importer posts.ndjson --author 1
+    python -m posts.importer posts.csv --format csv
+"""
+import argparse
+import asyncio
+import csv
+import json
+from datetime import datetime, timezone
+from typing import AsyncIterator
+
+from db import connect, database, disconnect, replicas
+from posts.cache import bump_feed
+from posts.models import Post
+from posts.schemas import PostImport, PostImportError, PostImportResult
+from pydantic import ValidationError
+from settings import (ID_MAX, POSTS_IMPORT_BATCH, POSTS_IMPORT_ERRORS,
+                      STARTUP_TIMEOUT)
+
+db_post = Post(database, replicas)
+
+""" Content types of the formats for the endpoint. """
+FORMATS = {"application/x-ndjson": "ndjson", "text/csv": "csv"}
+""" A longer line or CSV row is reported and skipped without being kept. """
+LINE_MAX = 1 << 20
+CHUNK = 1 << 16
+""" The csv module stops at 128 KiB a value otherwise. """
+csv.field_size_limit(LINE_MAX)
+
+Row = tuple[int, dict | str]
+
+
+async def lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, str | None]]:
+    """ Numbered lines of the stream, None for one too long or not UTF-8. """
+    buffer = b""
+    number = 0
+    too_long = False
+    async for chunk in chunks:
+        buffer += chunk
+        *complete, buffer = buffer.split(b"\n")
+        for line in complete:
+            number += 1
+            if too_long:
+                too_long = False
+                yield number, None
+                continue
+            try:
+                yield number, line.decode().rstrip("\r")
+            except UnicodeDecodeError:
+                yield number, None
+        if len(buffer) > LINE_MAX:
+            buffer, too_long = b"", True
+    if buffer or too_long:
+        try:
+            yield number + 1, None if too_long else buffer.decode().rstrip("\r")
+        except UnicodeDecodeError:
+            yield number + 1, None
+
+
+async def ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    async for number, line in lines(chunks):
+        if line is None:
+            yield number, "Line too long or not UTF-8"
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, "Invalid JSON"
+            continue
+        yield number, row if isinstance(row, dict) else "Not an object"
+
+
+async def csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Row]:
+    """ A quoted value may go on for several lines, the row is numbered by its first. """
+    header: list[str] | None = None
+    pending: list[str] = []
+    start = 0
+    async for number, line in lines(chunks):
+        if line is None:
+            pending = []
+            yield number, "Line too long or not UTF-8"
+            continue
+        if not pending:
+            start = number
+        pending.append(line)
+        text = "\n".join(pending)
+        if text.count('"') % 2:
+            if len(text) > LINE_MAX:
+                pending = []
+                yield start, "Row too long"
+            continue
+        pending = []
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error as error:
+            yield start, f"Invalid CSV: {error}"
+            continue
+        if header is None:
+            header = values
+        elif len(values) != len(header):
+            yield start, f"Expected {len(header)} values, got {len(values)}"
+        else:
+            yield start, {key: value for key, value in zip(header, values) if value != ""}
+    if pending:
+        yield start, "Unclosed quote"
+
+
+async def import_posts(
+    chunks: AsyncIterator[bytes], format: str, author: int | None, only_author: bool = False
+) -> PostImportResult:
+    """
+    Posts without an author get author. With only_author they must
+    all be of that author, the endpoint imports the posts of the user.
+    Every batch is committed on its own, rows that fail are counted
+    and the first POSTS_IMPORT_ERRORS are listed by line.
+    """
+    result = PostImportResult()
+    batch: list[tuple] = []
+
+    def fail(line: int, detail: str) -> None:
+        result.failed += 1
+        if len(result.errors) < POSTS_IMPORT_ERRORS:
+            result.errors.append(PostImportError(line=line, detail=detail))
+
+    async def flush() -> None:
+        missing = await db_post.copy_in(batch)
+        for line in missing:
+            fail(line, "No such author")
+        result.imported += len(batch) - len(missing)
+        await bump_feed(*{row[2] for row in batch})
+        batch.clear()
+
+    rows = csv_rows(chunks) if format == "csv" else ndjson_rows(chunks)
+    async for line, row in rows:
+        if isinstance(row, str):
+            fail(line, row)
+            continue
+        try:
+            post = PostImport(**row)
+        except ValidationError as error:
+            fail(line, "; ".join(
+                f"{'.'.join(map(str, i['loc']))} - {i['msg']}" for i in error.errors()
+            ))
+            continue
+        if "\x00" in post.text:
+            fail(line, "text - NUL characters are not allowed")
+            continue
+        try:
+            post.text.encode()
+        except UnicodeEncodeError:
+            fail(line, "text - not valid Unicode")
+            continue
+        if post.author is not None and not 0 < post.author <= ID_MAX:
+            fail(line, "No such author")
+            continue
+        if only_author and post.author not in (None, author):
+            fail(line, "Only your own posts")
+            continue
+        if post.author is None and author is None:
+            fail(line, "No author")
+            continue
+        timestamp = post.timestamp or datetime.now(timezone.utc)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        batch.append((line, post.text, post.author or author, timestamp))
+        if len(batch) >= POSTS_IMPORT_BATCH:
+            await flush()
+    if batch:
+        await flush()
+    return result
+
+
+async def read_file(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, CHUNK):
+            yield chunk
+
+
+async def main(path: str, format: str, author: int | None) -> None:
+    await connect(STARTUP_TIMEOUT)
+    try:
+        result = await import_posts(read_file(path), format, author)
+    finally:
+        await disconnect()
+    print(result.json(indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--author", type=int, default=None, help="for posts without one")
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.format, args.author))
@@ -1,15 +1,17 @@
-from typing import Any
+from datetime import datetime
+from typing import AsyncIterator
 
 import sqlalchemy as sa
 from asyncpg import Record
-from asyncpg.exceptions import ForeignKeyViolationError, UniqueViolationError
-from db import Base, metadata
+from asyncpg.exceptions import ForeignKeyViolationError
+from db import Base, db_redis, exports, metadata
+from posts.cache import cache_counters
 from posts.schemas import PostCreate
-from redis import Redis
-from settings import NOT_FOUND, REDIS_URL
+from settings import (POSTS_COUNT_CACHE_TTL, POSTS_SEARCH_WINDOW,
+                      TIMELINE_FANOUT_MAX)
+from sqlalchemy.dialects.postgresql import ARRAY, REGCLASS, TSVECTOR
 from sqlalchemy.sql import func
-
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
+from users.models import follows, users
 
 posts = sa.Table(
     "posts", metadata,
@@ -18,75 +20,378 @@ posts = sa.Table(
     sa.Column("author", sa.Integer, sa.ForeignKey("users.id", ondelete='CASCADE')),
     sa.Column("timestamp", sa.DateTime(timezone=True), default=func.now()),
     sa.Column("update_date", sa.DateTime(timezone=True), default=None, onupdate=func.now()),
+    sa.Column("like_count", sa.Integer, nullable=False, server_default="0"),
+    sa.Column("dislike_count", sa.Integer, nullable=False, server_default="0"),
+    sa.Column("search_vector", TSVECTOR),
 )
-likes = sa.Table(
-    "likes", metadata,
-    sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id", ondelete='CASCADE')),
-    sa.Column("post_id", sa.Integer, sa.ForeignKey("posts.id", ondelete='CASCADE')),
-    sa.UniqueConstraint('user_id', 'post_id', name='unique_for_like')
+sa.Index("ix_posts_timestamp_id", posts.c.timestamp.desc(), posts.c.id.desc())
+sa.Index(
+    "ix_posts_author_timestamp_id",
+    posts.c.author, posts.c.timestamp.desc(), posts.c.id.desc()
 )
-dislikes = sa.Table(
-    "dislikes", metadata,
-    sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id", ondelete='CASCADE')),
-    sa.Column("post_id", sa.Integer, sa.ForeignKey("posts.id", ondelete='CASCADE')),
-    sa.UniqueConstraint('user_id', 'post_id', name='unique_for_dislikes')
+sa.Index("ix_posts_search_vector", posts.c.search_vector, postgresql_using="gin")
+reactions = sa.Table(
+    "reactions", metadata,
+    sa.Column(
+        "user_id", sa.Integer,
+        sa.ForeignKey("users.id", ondelete='CASCADE'), primary_key=True
+    ),
+    sa.Column(
+        "post_id", sa.Integer,
+        sa.ForeignKey("posts.id", ondelete='CASCADE'), primary_key=True
+    ),
+    sa.Column("value", sa.SmallInteger, nullable=False),
+    sa.CheckConstraint("value IN (-1, 1)", name="reaction_value"),
 )
+sa.Index("ix_reactions_post_id", reactions.c.post_id)
+pg_class = sa.table("pg_class", sa.column("oid"), sa.column("reltuples"))
+
+""" Everything but the search vector, which only the search reads. """
+post_columns = [column for column in posts.c if column.name != "search_vector"]
+
+""" No stemming, posts are written in more than one language. """
+SEARCH_CONFIG = sa.literal_column("'simple'::regconfig")
+
+reactions_count = (
+    posts.c.like_count.label("like"),
+    posts.c.dislike_count.label("dislike"),
+)
+
+""" Like is 1 and dislike is -1, the same value again removes the reaction. """
+REACTION_TOGGLE = sa.text(
+    """
+    WITH post AS (
+        SELECT id, author, like_count, dislike_count FROM posts WHERE id = :post_id
+    ),
+    removed AS (
+        DELETE FROM reactions USING post
+        WHERE reactions.post_id = post.id
+            AND reactions.user_id = :user_id
+            AND reactions.value = :value
+            AND post.author <> :user_id
+        RETURNING reactions.value
+    ),
+    upserted AS (
+        INSERT INTO reactions (user_id, post_id, value)
+        SELECT :user_id, post.id, CAST(:value AS smallint) FROM post
+        WHERE post.author <> :user_id AND NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (user_id, post_id) DO UPDATE SET value = excluded.value
+        WHERE reactions.value <> excluded.value
+        RETURNING reactions.value, reactions.xmax = 0 AS inserted
+    ),
+    changes AS (
+        SELECT -CAST(value = 1 AS int) AS likes, -CAST(value = -1 AS int) AS dislikes
+        FROM removed
+        UNION ALL
+        SELECT
+            CAST(value = 1 AS int) - CAST(NOT inserted AND value = -1 AS int),
+            CAST(value = -1 AS int) - CAST(NOT inserted AND value = 1 AS int)
+        FROM upserted
+    ),
+    updated AS (
+        UPDATE posts SET
+            like_count = posts.like_count + changes.likes,
+            dislike_count = posts.dislike_count + changes.dislikes
+        FROM changes
+        WHERE posts.id = :post_id
+        RETURNING
+            posts.like_count,
+            posts.dislike_count,
+            CAST(extract(epoch FROM clock_timestamp()) * 1000000 AS bigint) AS stamp
+    )
+    SELECT
+        post.author,
+        coalesce(updated.like_count, post.like_count) AS "like",
+        coalesce(updated.dislike_count, post.dislike_count) AS dislike,
+        updated.stamp
+    FROM post LEFT JOIN updated ON true
+    """
+)
+
+""" Final reactions collected by the write-behind flusher, 0 means removed. """
+REACTIONS_UPSERT = sa.text(
+    """
+    INSERT INTO reactions (user_id, post_id, value)
+    SELECT changed.user_id, changed.post_id, changed.value
+    FROM unnest(
+        CAST(:user_ids AS int[]), CAST(:post_ids AS int[]), CAST(:values AS smallint[])
+    ) AS changed (user_id, post_id, value)
+    JOIN posts ON posts.id = changed.post_id
+    JOIN users ON users.id = changed.user_id
+    WHERE changed.value <> 0
+    ON CONFLICT (user_id, post_id) DO UPDATE SET value = excluded.value
+    WHERE reactions.value <> excluded.value
+    """
+)
+REACTIONS_REMOVE = sa.text(
+    """
+    DELETE FROM reactions
+    USING unnest(
+        CAST(:user_ids AS int[]), CAST(:post_ids AS int[]), CAST(:values AS smallint[])
+    ) AS changed (user_id, post_id, value)
+    WHERE reactions.user_id = changed.user_id
+        AND reactions.post_id = changed.post_id
+        AND changed.value = 0
+    """
+)
+REACTIONS_RECOUNT = sa.text(
+    """
+    UPDATE posts SET like_count = counted.likes, dislike_count = counted.dislikes
+    FROM (
+        SELECT
+            changed.post_id,
+            count(*) FILTER (WHERE reactions.value = 1) AS likes,
+            count(*) FILTER (WHERE reactions.value = -1) AS dislikes
+        FROM (SELECT DISTINCT unnest(CAST(:post_ids AS int[])) AS post_id) AS changed
+        LEFT JOIN reactions ON reactions.post_id = changed.post_id
+        GROUP BY changed.post_id
+    ) AS counted
+    WHERE posts.id = counted.post_id
+    RETURNING posts.author
+    """
+)
+
+""" Imported rows are copied here first, it is emptied when the batch commits. """
+POSTS_IMPORT_STAGE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS posts_import (
+        line int, text text, author int, timestamp timestamptz
+    ) ON COMMIT DELETE ROWS
+"""
+""" Moves the rows of known authors to posts and returns the lines of the rest. """
+POSTS_IMPORT_MOVE = """
+    WITH moved AS (
+        INSERT INTO posts (text, author, timestamp, search_vector)
+        SELECT staged.text, staged.author, staged.timestamp, to_tsvector('simple', staged.text)
+        FROM posts_import AS staged JOIN users ON users.id = staged.author
+        ORDER BY staged.line
+    )
+    SELECT line FROM posts_import AS staged
+    WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.id = staged.author)
+"""
 
 
 class Post(Base):
     async def create(self, post_items: dict) -> Record:
         return await self.database.fetch_one(
-            sa.insert(posts).values(post_items).returning(posts)
+            sa.insert(posts)
+            .values(
+                **post_items,
+                search_vector=func.to_tsvector(SEARCH_CONFIG, post_items["text"]),
+            )
+            .returning(*post_columns)
         )
 
+    async def copy_in(self, rows: list[tuple]) -> list[int]:
+        """
+        Rows of (line, text, author, timestamp) in one transaction: binary COPY
+        to a temporary table and one INSERT that adds the search vectors.
+        Returns the lines whose author does not exist, they are left out.
+        """
+        async with self.database.connection() as connection:
+            async with connection.transaction():
+                raw = connection.raw_connection
+                await raw.execute(POSTS_IMPORT_STAGE)
+                await raw.copy_records_to_table(
+                    "posts_import", records=rows, columns=["line", "text", "author", "timestamp"]
+                )
+                missing = await raw.fetch(POSTS_IMPORT_MOVE)
+        return [record["line"] for record in missing]
+
+    async def export(self, author: int | None = None) -> AsyncIterator[Record]:
+        """
+        Every post, or every post of the author, newest first.
+        The rows come through a server-side cursor a few at a time,
+        on the pool for exports, since the read can take a while.
+        """
+        query = (
+            sa.select(*post_columns, *reactions_count)
+            .order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+        )
+        if author:
+            query = query.where(posts.c.author == author)
+        async for row in exports.iterate(query):
+            yield row
+
     async def posts_count(self, author: int | None = None) -> Record:
         query = sa.select(func.count(posts.c.id).label("is_count"))
         if author:
             query = query.where(posts.c.author == author)
-        return await self.database.fetch_one(query)
+        return await self.read_one(query)
+
+    async def posts_estimate(self, author: int | None = None) -> int:
+        """
+        All posts are taken from the planner statistics,
+        until the table has been analyzed the count is exact.
+        Posts by an author are counted once and reused for a while.
+        """
+        if not author:
+            estimate = await self.database.fetch_one(
+                sa.select(sa.cast(pg_class.c.reltuples, sa.BigInteger))
+                .where(pg_class.c.oid == sa.cast("posts", REGCLASS))
+            )
+            if estimate and estimate[0] > 0:
+                return estimate[0]
+            return (await self.posts_count())[0]
+
+        cached = await db_redis.get(f"count:author={author}")
+        if cached is not None:
+            return int(cached)
+        count = (await self.posts_count(author))[0]
+        await db_redis.set(f"count:author={author}", count, ex=POSTS_COUNT_CACHE_TTL)
+        return count
 
     async def posts_all(
         self,
         page: int = 1,
         limit: int = 6,
-        author: int | None = None
+        author: int | None = None,
+        cursor: tuple[datetime, int] | None = None,
+        reverse: bool = False,
+        peek: bool = False,
+        total: bool = False,
     ) -> list[Record]:
+        """
+        Without a cursor pages with LIMIT/OFFSET.
+        With a cursor (timestamp, id) seeks past it on the keyset index,
+        reverse walks towards newer posts and returns them oldest first.
+        peek fetches one more row to tell if there is a next page,
+        total adds the number of matching posts to every row.
+        """
+
+        query = sa.select(*post_columns, *reactions_count).limit(limit + peek)
+        if total:
+            counted = posts.alias("counted")
+            count = sa.select(func.count(counted.c.id))
+            if author:
+                count = count.where(counted.c.author == author)
+            query = query.add_columns(count.scalar_subquery().label("total"))
+        position = sa.tuple_(posts.c.timestamp, posts.c.id)
+        if cursor is None:
+            query = query.offset((page - 1) * limit)
+        elif reverse:
+            query = query.where(position > sa.tuple_(*cursor))
+        else:
+            query = query.where(position < sa.tuple_(*cursor))
+        if reverse:
+            query = query.order_by(posts.c.timestamp.asc(), posts.c.id.asc())
+        else:
+            query = query.order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+        if author:
+            query = query.where(posts.c.author == author)
+        return await self.read_all(query)
 
+    async def timeline(
+        self, user_id: int, post_ids: list[int], page: int = 1, limit: int = 6
+    ) -> list[Record]:
+        """
+        A page of the home timeline and one more row: the posts
+        with the given ids together with the newest posts of the followed
+        authors that are not fanned out, newest first.
+        Only these ids are looked up and sorted, never the whole feed index.
+        """
+        newest = page * limit + 1
+        celebrities = (
+            sa.select(follows.c.author_id)
+            .join(users, users.c.id == follows.c.author_id)
+            .where(
+                follows.c.follower_id == user_id,
+                users.c.followers_count > TIMELINE_FANOUT_MAX,
+            )
+            .subquery()
+        )
+        recent = (
+            sa.select(posts.c.id)
+            .where(posts.c.author == celebrities.c.author_id)
+            .order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+            .limit(newest)
+            .lateral()
+        )
+        timeline_ids = sa.union_all(
+            sa.select(func.unnest(sa.cast(sa.bindparam("post_ids", post_ids), ARRAY(sa.Integer)))),
+            sa.select(recent.c.id).select_from(celebrities.join(recent, sa.true())),
+        )
+        return await self.database.fetch_all(
+            sa.select(*post_columns, *reactions_count)
+            .where(posts.c.id.in_(timeline_ids))
+            .order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+            .offset((page - 1) * limit)
+            .limit(limit + 1)
+        )
+
+    async def timeline_ids(self, user_id: int, size: int) -> list[Record]:
+        """ Ids and times of the newest posts by the user and the followed authors. """
+        return await self.database.fetch_all(
+            sa.select(posts.c.id, posts.c.timestamp)
+            .where(sa.or_(
+                posts.c.author == user_id,
+                posts.c.author.in_(
+                    sa.select(follows.c.author_id).where(follows.c.follower_id == user_id)
+                ),
+            ))
+            .order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+            .limit(size)
+        )
+
+    async def search(
+        self, text: str, limit: int = 6, cursor: tuple[float, int] | None = None
+    ) -> list[Record]:
+        """
+        Posts matching a web search style query, best ranked first,
+        with one more row to tell if there is a next page.
+        Only the newest POSTS_SEARCH_WINDOW matches are ranked: rare words
+        are found through the GIN index, common ones by walking
+        the timestamp index, the planner picks from the word statistics.
+        The cursor is the (rank, id) of the last post already shown.
+        """
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        recent = (
+            sa.select(posts)
+            .where(posts.c.search_vector.op("@@")(tsquery))
+            .order_by(posts.c.timestamp.desc(), posts.c.id.desc())
+            .limit(POSTS_SEARCH_WINDOW)
+            .subquery("recent")
+        )
+        rank = func.ts_rank(recent.c.search_vector, tsquery)
         query = (
             sa.select(
-                posts,
-                func.count(likes.c.user_id).label("like"),
-                func.count(dislikes.c.user_id).label("dislike")
+                *(recent.c[column.name] for column in post_columns),
+                recent.c.like_count.label("like"),
+                recent.c.dislike_count.label("dislike"),
+                rank.label("rank"),
             )
-            .join(likes, likes.c.post_id == posts.c.id, full=True)
-            .join(dislikes, dislikes.c.post_id == posts.c.id, full=True)
-            .limit(limit)
-            .offset((page - 1) * limit)
-            .group_by(posts.c.id)
-            .order_by(posts.c.timestamp.desc())
+            .order_by(rank.desc(), recent.c.id.desc())
+            .limit(limit + 1)
         )
-        if author:
-            query = query.where(posts.c.author == author)
+        if cursor:
+            query = query.where(
+                sa.tuple_(rank, recent.c.id) < sa.tuple_(sa.cast(cursor[0], sa.REAL), cursor[1])
+            )
         return await self.database.fetch_all(query)
 
     async def post_by_id(self, post_id: int) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(posts).where(posts.c.id == post_id)
-        )
+        return await self.read_one(self.prepared(
+            "post_by_id",
+            lambda: sa.select(*post_columns, *reactions_count)
+            .where(posts.c.id == sa.bindparam("post_id")),
+            post_id=post_id,
+        ))
 
     async def author_by_id(self, post_id: int) -> Record | None:
-        return await self.database.fetch_one(
-            sa.select(posts.c.author).where(posts.c.id == post_id)
-        )
+        return await self.database.fetch_one(self.prepared(
+            "author_by_id",
+            lambda: sa.select(posts.c.author).where(posts.c.id == sa.bindparam("post_id")),
+            post_id=post_id,
+        ))
 
     async def update(self, post_id: int, user_id: int, post_items: PostCreate) -> Record | None:
         return await self.database.fetch_one(
             sa.update(posts)
             .where(posts.c.id == post_id, posts.c.author == user_id)
-            .values(text=post_items.text)
-            .returning(posts)
+            .values(
+                text=post_items.text,
+                search_vector=func.to_tsvector(SEARCH_CONFIG, post_items.text),
+            )
+            .returning(*post_columns)
         )
 
     async def delete(self, post_id: int, user_id: int) -> Record | None:
@@ -100,48 +405,71 @@ class Post(Base):
 
 class LikeDislike(Base):
     async def count(self, post_id: int) -> Record:
-        """ Counts the number of likes and dislikes. """
-        return await self.database.fetch_one(
-            sa.select(
-                func.count(likes.c.user_id).label("like"),
-                func.count(dislikes.c.user_id).label("dislike")
-            )
-            .join(likes, likes.c.post_id == posts.c.id, full=True)
-            .join(dislikes, dislikes.c.post_id == posts.c.id, full=True)
-            .where(posts.c.id == post_id)
-            .group_by(posts.c.id)
-        )
-
-    async def _delete(self, post_id: int, user_id: int, model: Any) -> Any:
-        """ Gets the likes or dislikes model and removes what is needed. """
-        return await self.database.execute(
-            sa.delete(model).where(model.c.post_id == post_id, model.c.user_id == user_id)
-        )
+        """ Reads the number of likes and dislikes kept on the post. """
+        return await self.read_one(self.prepared(
+            "count",
+            lambda: sa.select(*reactions_count).where(posts.c.id == sa.bindparam("post_id")),
+            post_id=post_id,
+        ))
 
-    async def _create(self, post_id: int, user_id: int, model: Any) -> Any:
-        """ Gets the likes or dislikes model and creates what is needed. """
-        return await self.database.execute(
-            sa.insert(model).values(post_id=post_id, user_id=user_id)
+    async def count_many(self, post_ids: list[int]) -> list[Record]:
+        """ Likes and dislikes of several posts in one query. """
+        return await self.database.fetch_all(
+            sa.select(posts.c.id, *reactions_count)
+            .where(posts.c.id == sa.any_(
+                sa.bindparam("post_ids", post_ids, type_=ARRAY(sa.Integer))
+            ))
         )
 
-    async def like(self, post_id: int, user_id: int, like: bool = False) -> Any:
+    async def like(self, post_id: int, user_id: int, like: bool = False) -> Record | None:
         """
         The input receives a bool value like this or not.
         If like, creates like and removes dislikes.
         If like is already there, just delete it.
+        One statement checks the author, toggles the reaction
+        and moves the post counters, returns author, like and dislike.
+        The stamp is taken once the post row is locked, so later toggles
+        of the post have greater ones, and older counters never win in Redis.
+        None if there is no such post, the author's own post is left as is.
         """
-        model_one, model_two = dislikes, likes
-        if like:
-            model_one, model_two = likes, dislikes
         try:
-            await self._create(post_id, user_id, model_one)
-        except UniqueViolationError:
-            await self._delete(post_id, user_id, model_one)
+            record = await self.database.fetch_one(REACTION_TOGGLE.bindparams(
+                post_id=post_id, user_id=user_id, value=1 if like else -1
+            ))
         except ForeignKeyViolationError:
-            return NOT_FOUND
-        else:
-            await self._delete(post_id, user_id, model_two)
-
-        record = dict(await self.count(post_id))
-        db_redis.hmset(f"id={post_id}", record)
+            return None
+        if record and record["stamp"]:
+            await cache_counters(post_id, record["like"], record["dislike"], record["stamp"])
         return record
+
+    async def state(self, post_id: int, user_id: int) -> Record | None:
+        """ The post author, its counters and the reaction of the user, 0 if none. """
+        return await self.database.fetch_one(
+            sa.select(
+                posts.c.author,
+                *reactions_count,
+                func.coalesce(reactions.c.value, 0).label("value"),
+            )
+            .select_from(posts.outerjoin(reactions, sa.and_(
+                reactions.c.post_id == posts.c.id, reactions.c.user_id == user_id
+            )))
+            .where(posts.c.id == post_id)
+        )
+
+    async def apply(self, changes: list[tuple[int, int, int]]) -> list[int]:
+        """
+        Writes the final (post_id, user_id, value) reactions in one transaction
+        and recounts the affected posts, so applying a batch twice is harmless.
+        Reactions of deleted posts or users are skipped.
+        Returns the authors of the recounted posts.
+        """
+        post_ids, user_ids, values = (list(i) for i in zip(*changes))
+        async with self.database.transaction():
+            for statement in (REACTIONS_UPSERT, REACTIONS_REMOVE):
+                await self.database.execute(statement.bindparams(
+                    post_ids=post_ids, user_ids=user_ids, values=values
+                ))
+            records = await self.database.fetch_all(
+                REACTIONS_RECOUNT.bindparams(post_ids=post_ids)
+            )
+        return [record["author"] for record in records]
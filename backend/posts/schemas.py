@@ -15,17 +15,37 @@ class PostCreate(BaseModel):
     text: str
 
 
+class PostImport(PostCreate):
+    timestamp: datetime | None = None
+    author: int | None = None
+
+
+class PostImportError(BaseModel):
+    line: int
+    detail: str
+
+
+class PostImportResult(BaseModel):
+    imported: int = 0
+    failed: int = 0
+    errors: list[PostImportError] = []
+
+
 class PostLike(BaseModel):
     like: int
     dislike: int
 
 
+class PostReactions(PostLike):
+    id: int
+
+
 class PostDetail(PostLike, PostBase):
     pass
 
 
 class PostList(BaseModel):
-    count: int
+    count: int | None
     next: str | None = None
     previous: str | None = None
     results: list[PostDetail] = []
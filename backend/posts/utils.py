@@ -1,27 +1,145 @@
+import base64
+import binascii
+from datetime import datetime
 from typing import Any
 
-from db import database
-from fastapi import status
+from db import database, db_redis, replicas
+from fastapi import HTTPException, status
 from fastapi.responses import JSONResponse
+from metrics import cache_result
+from posts.buffer import reaction_buffer
+from posts.cache import bump_feed, fill_counters
 from posts.models import LikeDislike, Post
-from settings import NOT_FOUND
+from settings import (ID_MAX, NOT_FOUND, REACTIONS_WRITE_BEHIND,
+                      TIMELINE_FANOUT_MAX, TIMELINE_SIZE, TIMELINE_TTL)
+from starlette.datastructures import URL
 from starlette.requests import Request
+from users.models import Follow
 
-db_post = Post(database)
-db_like = LikeDislike(database)
+db_post = Post(database, replicas)
+db_like = LikeDislike(database, replicas)
+db_follow = Follow(database)
+
+""" Adds a post to the timelines in KEYS that exist and trims them to the size. """
+TIMELINE_PUSH = db_redis.register_script(
+    """
+    for _, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            redis.call('ZADD', key, ARGV[1], ARGV[2])
+            redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[3]) - 1)
+        end
+    end
+    """
+)
+
+
+def encode_cursor(timestamp: datetime, post_id: int, reverse: bool = False) -> str:
+    """ Packs a keyset position into an opaque token for the client. """
+    raw = f"{int(reverse)}|{timestamp.isoformat()}|{post_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int, bool]:
+    """ Unpacks a token made by encode_cursor. """
+    try:
+        reverse, timestamp, post_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        if not 0 <= int(post_id) <= ID_MAX:
+            raise ValueError(post_id)
+        return datetime.fromisoformat(timestamp), int(post_id), reverse == "1"
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+
+
+def encode_search_cursor(rank: float, post_id: int) -> str:
+    """ Packs the rank and id of the last search result. """
+    return base64.urlsafe_b64encode(f"{rank!r}|{post_id}".encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    """ Unpacks a token made by encode_search_cursor. """
+    try:
+        rank, post_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        if not 0 <= int(post_id) <= ID_MAX:
+            raise ValueError(post_id)
+        return float(rank), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
 
 
-async def query_list(query: list, request: Request, count: int, page: int, limit: int) -> dict:
+def _relative(url: URL) -> str:
+    """
+    Links are the path and the query only, so a page does not depend
+    on the Host of the request that built it and may be cached for all.
+    """
+    return f"{url.path}?{url.query}" if url.query else url.path
+
+
+def _cursor_url(request: Request, cursor: str) -> str:
+    return _relative(request.url.remove_query_params("page").include_query_params(cursor=cursor))
+
+
+async def posts_total(query: list, author: int | None, total: str) -> int | None:
+    """
+    The number of posts for the requested mode: exact comes with the page
+    and is only counted separately when the page is empty,
+    estimate is approximate and none skips the count.
+    """
+    if total == "none":
+        return None
+    if total == "estimate":
+        return await db_post.posts_estimate(author)
+    if query:
+        return query[0].total
+    return (await db_post.posts_count(author))[0]
+
+
+async def query_list(
+    query: list,
+    request: Request,
+    count: int | None,
+    page: int,
+    limit: int,
+    cursor: str | None = None,
+) -> dict:
     """
     Composes a json response for the user in accordance with the requirements.
     Composes the next, previous, and number of pages to paginate.
+    In cursor mode, or without a count, the query holds up to limit + 1 rows
+    in fetch order, the extra row only tells whether there is one more page.
     """
+    if cursor is not None:
+        reverse = decode_cursor(cursor)[2] if cursor else False
+        has_more = len(query) > limit
+        query = query[:limit]
+        if reverse:
+            query.reverse()
+        next_page = previous = None
+        if query:
+            first, last = query[0], query[-1]
+            if has_more or reverse:
+                next_page = _cursor_url(request, encode_cursor(last.timestamp, last.id))
+            if cursor and (has_more or not reverse):
+                previous = _cursor_url(request, encode_cursor(first.timestamp, first.id, True))
+        return {
+            "count": count,
+            "next": next_page,
+            "previous": previous,
+            "results": query
+        }
+
+    if count is None:
+        has_more = len(query) > limit
+        query = query[:limit]
+    else:
+        has_more = page * limit < count
     next_page = (
-        str(request.url).replace(f"page={page}", f"page={page + 1}")
-        if page and page * limit < count else None
+        _relative(request.url.include_query_params(page=page + 1))
+        if page and has_more else None
     )
     previous = (
-        str(request.url).replace(f"page={page}", f"page={page - 1}")
+        _relative(request.url.include_query_params(page=page - 1))
         if page and page > 1 else None
     )
     return {
@@ -32,14 +150,128 @@ async def query_list(query: list, request: Request, count: int, page: int, limit
     }
 
 
+async def feed_page(
+    request: Request,
+    page: int,
+    limit: int,
+    author: int | None,
+    cursor: str | None,
+    total: str,
+) -> dict:
+    """ A page of the feed of all posts or of one author. """
+    position, reverse = None, False
+    if cursor:
+        timestamp, post_id, reverse = decode_cursor(cursor)
+        position = (timestamp, post_id)
+    query = await db_post.posts_all(
+        page if cursor is None else 1,
+        limit,
+        author,
+        position,
+        reverse,
+        peek=cursor is not None or total == "none",
+        total=total == "exact",
+    )
+    count = await posts_total(query, author, total)
+    return await query_list(query, request, count, page, limit, cursor)
+
+
+async def search_list(query: list, request: Request, limit: int) -> dict:
+    """ Search results only go forward, the extra row tells if there are more. """
+    next_page = None
+    if len(query) > limit:
+        query = query[:limit]
+        next_page = _cursor_url(request, encode_search_cursor(query[-1].rank, query[-1].id))
+    return {
+        "count": None,
+        "next": next_page,
+        "previous": None,
+        "results": query
+    }
+
+
+async def reactions_by_ids(post_ids: list[int]) -> list[dict]:
+    """
+    Reads the cached counters of all posts in one pipeline,
+    the misses are fetched in one query and cached in one more pipeline.
+    Posts that do not exist are left out.
+    """
+    async with db_redis.pipeline(transaction=False) as pipe:
+        for post_id in post_ids:
+            pipe.hgetall(f"id={post_id}")
+        cached = await pipe.execute()
+    for record in cached:
+        cache_result("reactions", bool(record))
+    found = {
+        post_id: {"like": int(record["like"]), "dislike": int(record["dislike"])}
+        for post_id, record in zip(post_ids, cached) if record
+    }
+    missing = [post_id for post_id in post_ids if post_id not in found]
+    if missing:
+        records = await db_like.count_many(missing)
+        async with db_redis.pipeline(transaction=False) as pipe:
+            for record in records:
+                found[record.id] = {"like": record.like, "dislike": record.dislike}
+                await fill_counters(pipe, record.id, record.like, record.dislike)
+            await pipe.execute()
+    return [{"id": post_id, **found[post_id]} for post_id in post_ids if post_id in found]
+
+
+async def fan_out(post: Any) -> None:
+    """
+    Puts a new post into the timelines of the author and the followers,
+    a thousand keys per script call. Authors with more followers than
+    TIMELINE_FANOUT_MAX are skipped, their posts are merged in on read.
+    Timelines that are not built yet pick the post up when they are.
+    """
+    follower_ids = await db_follow.follower_ids(post["author"], TIMELINE_FANOUT_MAX + 1)
+    if len(follower_ids) > TIMELINE_FANOUT_MAX:
+        follower_ids = []
+    keys = [f"timeline={user_id}" for user_id in (post["author"], *follower_ids)]
+    for start in range(0, len(keys), 1000):
+        await TIMELINE_PUSH(
+            keys[start:start + 1000], [post["timestamp"].timestamp(), post["id"], TIMELINE_SIZE]
+        )
+
+
+async def timeline_page(user_id: int, page: int, limit: int) -> list:
+    """
+    One ZREVRANGE for the fanned out post ids and one query for the posts,
+    a timeline that expired or was dropped is rebuilt from the follows.
+    """
+    key = f"timeline={user_id}"
+    post_ids = await db_redis.zrevrange(key, 0, page * limit)
+    if not post_ids and not await db_redis.exists(key):
+        records = await db_post.timeline_ids(user_id, TIMELINE_SIZE)
+        if records:
+            async with db_redis.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.zadd(key, {
+                    record["id"]: record["timestamp"].timestamp() for record in records
+                })
+                pipe.expire(key, TIMELINE_TTL)
+                await pipe.execute()
+        post_ids = [record["id"] for record in records[:page * limit + 1]]
+    return await db_post.timeline(user_id, [int(i) for i in post_ids], page, limit)
+
+
 async def check_author(post_id: int, user_id: int, like: bool) -> Any:
-    author = await db_post.author_by_id(post_id)
-    if not author:
+    """
+    With write-behind the reaction reaches Postgres later
+    and the flusher invalidates the cached feed pages.
+    """
+    if REACTIONS_WRITE_BEHIND:
+        record = await reaction_buffer.toggle(post_id, user_id, like)
+    else:
+        record = await db_like.like(post_id, user_id, like)
+    if not record:
         return NOT_FOUND
-    if author.author == user_id:
+    if record["author"] == user_id:
         return JSONResponse(
             {"detail": "Just not your post"},
             status.HTTP_418_IM_A_TEAPOT,
             # as option HTTP_403_FORBIDDEN
         )
-    return await db_like.like(post_id, user_id, like)
+    if not REACTIONS_WRITE_BEHIND:
+        await bump_feed(record["author"])
+    return {"like": record["like"], "dislike": record["dislike"]}
@@ -1,3 +1,4 @@
+import json
 import os
 
 from dotenv import load_dotenv
@@ -8,6 +9,108 @@ load_dotenv()
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 5
 REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
+""" Sessions a user keeps, a new login past it ends the oldest one. """
+REFRESH_SESSIONS_MAX = int(os.getenv("REFRESH_SESSIONS_MAX", default="10"))
+
+""" Bcrypt runs in these threads, callers beyond the queue get 503. """
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", default="2"))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", default="16"))
+
+""" Authenticated users are kept per process, other workers see changes after the TTL. """
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", default="30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", default="10000"))
+
+"""
+Post responses are encoded from the rows with orjson, skipping the pydantic models.
+The schemas in OpenAPI stay the same.
+"""
+FAST_JSON = os.getenv("FAST_JSON", default="False") == "True"
+
+"""
+Token buckets by "METHOD /path" of the route: requests a second, the burst,
+and whose bucket it is, the user of the token or the client host.
+RATE_LIMITS takes the same as JSON to change or add routes,
+RATE_LIMIT=False turns limiting off.
+"""
+RATE_LIMITS: dict[str, tuple[float, int, str]] = {
+    "POST /api/auth/token/login": (0.1, 30, "host"),
+    "POST /api/users/signup": (0.05, 10, "host"),
+    "POST /api/posts/create": (1, 60, "user"),
+    "POST /api/posts/{post_id}/like": (5, 100, "user"),
+    "POST /api/posts/{post_id}/dislike": (5, 100, "user"),
+    "GET /api/posts/export": (0.01, 5, "host"),
+    **json.loads(os.getenv("RATE_LIMITS", default="{}")),
+}
+if os.getenv("RATE_LIMIT", default="True") != "True":
+    RATE_LIMITS = {}
+
+"""
+Latency of the routes, the model methods and Redis, and the cache hit rates,
+exposed at GET /metrics. METRICS=False leaves the timing out.
+"""
+METRICS = os.getenv("METRICS", default="True") == "True"
+
+"""
+Statements slower than SLOW_QUERY_MS are logged with their parameters and
+the model method, at most SLOW_QUERY_LOG_MAX a minute in every process.
+A share of them, SLOW_QUERY_EXPLAIN, also gets the plan. 0 turns the log off.
+"""
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", default="500"))
+SLOW_QUERY_LOG_MAX = int(os.getenv("SLOW_QUERY_LOG_MAX", default="10"))
+SLOW_QUERY_EXPLAIN = float(os.getenv("SLOW_QUERY_EXPLAIN", default="0.1"))
+
+"""
+Bulk imports write POSTS_IMPORT_BATCH posts per COPY
+and list the first POSTS_IMPORT_ERRORS rows that failed.
+"""
+POSTS_IMPORT_BATCH = int(os.getenv("POSTS_IMPORT_BATCH", default="5000"))
+POSTS_IMPORT_ERRORS = int(os.getenv("POSTS_IMPORT_ERRORS", default="100"))
+
+""" The most posts a page of the feed, search or timeline may have. """
+POSTS_PAGE_MAX = int(os.getenv("POSTS_PAGE_MAX", default="100"))
+
+""" The most posts GET /api/posts/reactions answers for at once. """
+REACTIONS_BATCH_MAX = int(os.getenv("REACTIONS_BATCH_MAX", default="100"))
+
+"""
+Reactions are kept in Redis and a background task writes them to Postgres
+every REACTIONS_FLUSH_INTERVAL seconds, REACTIONS_FLUSH_BATCH entries at a time.
+"""
+REACTIONS_WRITE_BEHIND = os.getenv("REACTIONS_WRITE_BEHIND", default="False") == "True"
+REACTIONS_FLUSH_INTERVAL = float(os.getenv("REACTIONS_FLUSH_INTERVAL", default="1"))
+REACTIONS_FLUSH_BATCH = int(os.getenv("REACTIONS_FLUSH_BATCH", default="1000"))
+REACTIONS_STATE_TTL = int(os.getenv("REACTIONS_STATE_TTL", default="86400"))
+
+"""
+Home timelines keep the newest TIMELINE_SIZE posts and are filled when a post
+is created, posts of authors with more than TIMELINE_FANOUT_MAX followers
+are merged in when a timeline is read instead.
+"""
+TIMELINE_SIZE = int(os.getenv("TIMELINE_SIZE", default="800"))
+TIMELINE_FANOUT_MAX = int(os.getenv("TIMELINE_FANOUT_MAX", default="10000"))
+TIMELINE_TTL = int(os.getenv("TIMELINE_TTL", default=str(60 * 60 * 24 * 7)))
+
+"""
+Search ranks at most this many of the newest matching posts,
+so a word found in most posts costs the same on any table size.
+"""
+POSTS_SEARCH_WINDOW = int(os.getenv("POSTS_SEARCH_WINDOW", default="5000"))
+
+"""
+The first FEED_CACHE_PAGES pages of GET /api/posts are cached for FEED_CACHE_TTL
+seconds, any change to the posts they show invalidates them at once.
+"""
+FEED_CACHE_PAGES = int(os.getenv("FEED_CACHE_PAGES", default="5"))
+FEED_CACHE_TTL = int(os.getenv("FEED_CACHE_TTL", default="60"))
+
+"""
+Posts and their counters are cached for POST_CACHE_TTL seconds after a read,
+an edit or a removal drops the post at once.
+"""
+POST_CACHE_TTL = int(os.getenv("POST_CACHE_TTL", default="300"))
+
+""" How long the estimated number of posts by an author is reused. """
+POSTS_COUNT_CACHE_TTL = int(os.getenv("POSTS_COUNT_CACHE_TTL", default="60"))
 
 ALGORITHM = os.getenv("ALGORITHM", default="HS256")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", default="key")
@@ -19,9 +122,44 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", default="postgres")
 POSTGRES_SERVER = os.getenv("POSTGRES_SERVER", default="localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", default="5432")
 
+"""
+Server processes and the connections all of them may open together,
+every worker gets an equal share unless its pool sizes are set.
+By default a worker gets as many as the single process had before.
+"""
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", default="1"))
+POSTGRES_CONNECTIONS = int(os.getenv(
+    "POSTGRES_CONNECTIONS", default=str(10 * WEB_CONCURRENCY)
+))
+REDIS_CONNECTIONS = int(os.getenv("REDIS_CONNECTIONS", default=str(20 * WEB_CONCURRENCY)))
+
+"""
+Exports hold a connection for as long as they stream, they get a pool of their own
+in every worker, on the first replica if there is one. Its connections open on demand
+and come out of the share of the worker.
+"""
+POSTGRES_EXPORT_POOL_MAX = int(os.getenv("POSTGRES_EXPORT_POOL_MAX", default="1"))
+""" Connections the pool of one worker opens at startup and the most it keeps. """
+POSTGRES_POOL_MAX = int(os.getenv(
+    "POSTGRES_POOL_MAX",
+    default=str(max(1, POSTGRES_CONNECTIONS // WEB_CONCURRENCY - POSTGRES_EXPORT_POOL_MAX)),
+))
+POSTGRES_POOL_MIN = min(int(os.getenv("POSTGRES_POOL_MIN", default="10")), POSTGRES_POOL_MAX)
+
 REDIS_HOST = os.getenv("REDIS_HOST", default="localhost")
 REDIS_PORT = os.getenv("REDIS_PORT", default="6379")
-REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
+""" The database number, the tests use their own. """
+REDIS_DB = int(os.getenv("REDIS_DB", default="0"))
+REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
+REDIS_POOL_SIZE = int(os.getenv(
+    "REDIS_POOL_SIZE", default=str(max(1, REDIS_CONNECTIONS // WEB_CONCURRENCY))
+))
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", default="5"))
+""" Redis connections opened at startup, the rest are opened on demand. """
+REDIS_POOL_MIN = min(int(os.getenv("REDIS_POOL_MIN", default="5")), REDIS_POOL_SIZE)
+
+""" How long startup waits for Postgres and Redis to accept connections. """
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", default="30"))
 
 TESTING = os.getenv("TESTING", default="False")
 if TESTING == "True":
@@ -32,6 +170,20 @@ DATABASE_URL = (f"postgresql://{POSTGRES_USER}:"
                 f"{POSTGRES_PORT}/"
                 f"{POSTGRES_DB}")
 
+"""
+Read replicas as host:port separated by commas, with the same database and user.
+A user's reads go to the primary for READ_YOUR_WRITES seconds after they write.
+"""
+POSTGRES_REPLICAS = [i for i in os.getenv("POSTGRES_REPLICAS", default="").split(",") if i]
+REPLICA_URLS = [
+    f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{replica}/{POSTGRES_DB}"
+    for replica in POSTGRES_REPLICAS
+]
+READ_YOUR_WRITES = int(os.getenv("READ_YOUR_WRITES", default="5"))
+
+""" The largest id an integer column holds, a larger one fails in Postgres. """
+ID_MAX = 2**31 - 1
+
 NOT_FOUND = JSONResponse({"detail": "NotFound"}, status.HTTP_404_NOT_FOUND)
 
 """ For tests. """
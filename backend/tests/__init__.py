@@ -0,0 +1,4 @@
+import os
+
+""" Read by settings before the app is imported, the suite flushes this Redis database. """
+os.environ.setdefault("REDIS_DB", "15")
@@ -2,11 +2,13 @@ import dataclasses
 from typing import Any, Generator
 
 import pytest
+import redis
 import sqlalchemy
 from db import metadata
 from fastapi.testclient import TestClient
 from main import app
-from settings import DATABASE_URL, HOST
+from middleware import RateLimit
+from settings import DATABASE_URL, HOST, REDIS_DB, REDIS_URL
 
 
 @dataclasses.dataclass
@@ -21,13 +23,24 @@ class Cache:
 
 @pytest.fixture(autouse=True, scope="session")
 def create_test_database() -> Generator:
-    """ We create tables. """
+    """ We create tables, the cached state of a previous run is dropped. """
     engine = sqlalchemy.create_engine(DATABASE_URL)
     metadata.create_all(engine)
+    assert REDIS_DB != 0, "The tests flush their Redis database, set REDIS_DB to a spare one"
+    redis.Redis.from_url(REDIS_URL).flushdb()
     yield
     metadata.drop_all(engine)
 
 
+@pytest.fixture(autouse=True, scope="session")
+def rate_limit_off() -> None:
+    """ Buckets outlive the run, only test_rate_limit sets limits. """
+    limiter = app.middleware_stack
+    while not isinstance(limiter, RateLimit):
+        limiter = limiter.app
+    limiter.limits = []
+
+
 @pytest.fixture
 def client() -> Generator:
     """ We connect to the database. """
@@ -1,7 +1,11 @@
 from typing import Any
 
+from db import db_redis
 from fastapi import status
+from settings import REFRESH_TOKEN_EXPIRE_MINUTES
 from tests.conftest import HOST, Cache
+from users.models import User
+from users.utils import user_cache
 
 
 def test_post_user_create(client: Any, user_one: dict, user_other: dict, host: Any) -> None:
@@ -46,6 +50,15 @@ def test_post_login_incorrect(client: Any, user_one: dict, host: Any) -> None:
     assert response.status_code == status.HTTP_400_BAD_REQUEST
 
 
+def test_post_login_hash_queue_full(client: Any, user_one: dict, host: Any, mocker: Any) -> None:
+    mocker.patch("users.utils.hash_pool.queue", 0)
+    data = {"username": user_one["username"], "password": user_one["password"]}
+    response = client.post("/api/auth/token/login", data=data)
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json() == {"detail": "Too many authentication requests"}
+    assert response.headers["retry-after"] == "1"
+
+
 def test_post_login_max_10(client: Any, user_one: dict, host: Any) -> None:
     data = {"username": user_one["username"], "password": user_one["password"]}
     response = client.post("/api/auth/token/login", data=data)
@@ -62,6 +75,15 @@ def test_post_login_max_10(client: Any, user_one: dict, host: Any) -> None:
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
 
 
+def test_sessions_bounded(client: Any) -> None:
+    user_id = Cache.user_one["id"]
+    sessions = client.portal.call(db_redis.zrange, f"sessions={user_id}", 0, -1)
+    assert sessions == [f"127.0.0.{num}" for num in range(2, 12)]
+    assert client.portal.call(db_redis.hlen, f"user={user_id}") == 10
+    ttl = client.portal.call(db_redis.ttl, f"sessions={user_id}")
+    assert 0 < ttl <= REFRESH_TOKEN_EXPIRE_MINUTES * 60
+
+
 def test_post_login(client: Any, user_one: dict, user_other: dict, host: Any) -> None:
     data = {"username": user_one["username"], "password": user_one["password"]}
     response = client.post("/api/auth/token/login", data=data)
@@ -87,6 +109,15 @@ def test_get_me(client: Any, user_one: dict) -> None:
     assert user_one["email"] in response.json()["email"]
 
 
+def test_get_me_cached(client: Any, mocker: Any) -> None:
+    user_cache.data.clear()
+    spy = mocker.spy(User, "user_by_id")
+    for _ in range(3):
+        response = client.get("/api/users/me", headers=Cache.headers)
+        assert response.status_code == status.HTTP_200_OK
+    assert spy.call_count == 1
+
+
 def test_get_user(client: Any, user_one: dict, user_other: dict) -> None:
     user_id = Cache.user_one["id"]
     response = client.get(f"/api/users/{user_id}")
@@ -106,6 +137,11 @@ def test_post_token_refresh(client: Any, host: Any) -> None:
     assert "refresh_token" in response.json()
 
 
+def test_post_token_refresh_reused(client: Any, host: Any) -> None:
+    response = client.post("/api/auth/token/refresh", json=Cache.refresh_token)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
 def test_post_token_refresh_other_ip(client: Any, host: Any) -> None:
     host.host = "127.0.0.1"
     response = client.post("/api/auth/token/refresh", json=Cache.refresh_token)
@@ -118,6 +154,9 @@ def test_put_set_password(client, user_one):
         "current_password": user_one["password"],
         "new_password": "new_password"
     }
+    client.get("/api/users/me", headers=Cache.headers)
+    stale = user_cache.get(Cache.user_one["id"])
+    assert stale is not None
     response = client.put(
         "/api/users/set_password",
         headers=Cache.headers,
@@ -125,6 +164,17 @@ def test_put_set_password(client, user_one):
     )
     assert response.status_code == 200
     assert response.json() == {"detail": "Changed"}
+    assert user_cache.get(Cache.user_one["id"]) is None
+
+    # another worker still has the user with the old password
+    user_cache.set(Cache.user_one["id"], stale)
+    response = client.put(
+        "/api/users/set_password",
+        headers=Cache.headers,
+        json={**set_password, "new_password": "stale_password"},
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    user_cache.delete(Cache.user_one["id"])
 
     data = {
         "username": user_one["username"],
@@ -132,3 +182,11 @@ def test_put_set_password(client, user_one):
     }
     response = client.post("/api/auth/token/login", data=data)
     assert response.status_code == 200
+
+
+def test_post_logout(client: Any) -> None:
+    client.get("/api/users/me", headers=Cache.headers_other)
+    assert user_cache.get(Cache.user_other["id"]) is not None
+    response = client.post("/api/auth/token/logout", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert user_cache.get(Cache.user_other["id"]) is None
@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+import time
+from typing import Any
+
+from db import slow_query_log
+from fastapi import status
+from fastapi.testclient import TestClient
+from main import app
+from middleware import RateLimit
+from tests.conftest import Cache
+
+""" Measured at about 0.6 s, the rest is headroom for slower machines. """
+IMPORT_BUDGET = 2.0
+STARTUP_BUDGET = 2.0
+
+IMPORT_MAIN = """
+import time
+started_at = time.perf_counter()
+import main
+print(time.perf_counter() - started_at)
+"""
+
+POOL_SIZES = """
+import settings
+print(settings.POSTGRES_POOL_MIN, settings.POSTGRES_POOL_MAX)
+print(settings.REDIS_POOL_SIZE, settings.REDIS_POOL_MIN)
+"""
+
+
+def test_import_without_databases() -> None:
+    env = {
+        **os.environ,
+        "TESTING": "False",
+        "POSTGRES_SERVER": "127.0.0.1",
+        "POSTGRES_PORT": "1",
+        "REDIS_PORT": "1",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_MAIN],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout) < IMPORT_BUDGET
+
+
+def test_pools_share_the_budget() -> None:
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY": "4",
+        "POSTGRES_CONNECTIONS": "40",
+        "REDIS_CONNECTIONS": "80",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", POOL_SIZES],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.stdout.split() == ["9", "9", "20", "5"]
+
+
+def test_health_ready(client: Any) -> None:
+    response = client.get("/health/ready")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"detail": "Ready"}
+
+
+def test_health_not_ready() -> None:
+    client = TestClient(app)
+    assert client.get("/health/ready").status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    started_at = time.perf_counter()
+    with client:
+        assert time.perf_counter() - started_at < STARTUP_BUDGET
+        assert client.get("/health/ready").status_code == status.HTTP_200_OK
+    assert client.get("/health/ready").status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_rate_limit(client: Any, mocker: Any) -> None:
+    limiter = app.middleware_stack
+    while not isinstance(limiter, RateLimit):
+        limiter = limiter.app
+    limits = {"GET /health/ready": (1, 2, "user")}
+    mocker.patch.object(limiter, "limits", RateLimit.compile(limits))
+    responses = [client.get("/health/ready", headers=Cache.headers) for _ in range(3)]
+    assert [i.status_code for i in responses] == [200, 200, 429]
+    assert responses[-1].headers["retry-after"] == "1"
+    assert responses[-1].json() == {"detail": "Too many requests"}
+    response = client.get("/health/ready", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_metrics(client: Any) -> None:
+    client.get("/api/posts/0")
+    client.get("/api/users/me", headers=Cache.headers)
+    response = client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    metrics = response.text
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/api/posts/{post_id}",'
+        'status="404"}'
+    ) in metrics
+    assert 'http_requests_in_flight{method="GET",route="/api/posts/{post_id}"} 0.0' in metrics
+    assert 'db_query_duration_seconds_count{query="Post.post_by_id"}' in metrics
+    assert 'redis_command_duration_seconds_count{command="EVALSHA"}' in metrics
+    assert 'cache_requests_total{cache="token_user",result="hit"}' in metrics
+
+
+def test_slow_query_log(client: Any, mocker: Any, caplog: Any) -> None:
+    mocker.patch.multiple(slow_query_log, threshold=1e-9, limit=1, explain=1, logged=0)
+    response = client.get(f"/api/users/{Cache.user_one['id']}")
+    assert response.status_code == status.HTTP_200_OK
+    client.portal.call(slow_query_log.drain)
+    logs = [i.getMessage() for i in caplog.records if i.name == "db"]
+    assert len(logs) == 1
+    assert logs[0].startswith("Slow query User.user_by_id")
+    assert f"params: [{Cache.user_one['id']}]" in logs[0]
+    assert "actual time" in logs[0] and "Buffers" in logs[0]
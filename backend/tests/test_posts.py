@@ -1,6 +1,19 @@
-from typing import Any
+import json
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, AsyncIterator
 
+import databases
+from db import Base, database, db_redis, exports, replicas
 from fastapi import status
+from posts.buffer import REACTIONS_GROUP, REACTIONS_LOG, reaction_buffer
+from posts.cache import PostCache, cache_counters, drop_post
+from posts.importer import import_posts
+from posts.models import Post
+from posts.schemas import PostDetail, PostImportError
+from posts.utils import db_like, db_post, encode_cursor, encode_search_cursor
+from settings import DATABASE_URL
+from sqlalchemy.sql import Select
 from tests.conftest import Cache
 
 
@@ -37,6 +50,48 @@ def test_get_post(client: Any, post: list) -> None:
     assert response.json()["text"] == post[0]["text"]
 
 
+def test_get_post_compiled_once(client: Any, mocker: Any) -> None:
+    client.get(f"/api/posts/{Cache.post[0]}")
+    compile = mocker.spy(Select, "compile")
+    response = client.get(f"/api/posts/{Cache.post[1]}")
+    assert response.json()["id"] == Cache.post[1]
+    assert compile.call_count == 0
+    assert "Post.post_by_id" in Base.compiled
+
+
+def test_get_post_cached(client: Any, mocker: Any) -> None:
+    url, key = f"/api/posts/{Cache.post[0]}", f"post={Cache.post[0]}"
+    client.get(url)
+    post_by_id = mocker.spy(Post, "post_by_id")
+    assert client.get(url).json() == client.get(url).json()
+    assert post_by_id.call_count == 0
+
+    # a write lands between the read of the cache and the query
+    client.portal.call(db_redis.delete, key)
+    cache = PostCache(Cache.post[0])
+    assert client.portal.call(cache.cached) is None
+    client.portal.call(drop_post, Cache.post[0])
+    client.portal.call(cache.load, partial(db_post.post_by_id, Cache.post[0]))
+    assert client.portal.call(db_redis.hget, key, "body") is None
+    assert client.get(url).json()["id"] == Cache.post[0]
+    assert client.portal.call(db_redis.hget, key, "body") is not None
+
+    # a like lands after the query, its counters stay
+    counters = f"id={Cache.post[0]}"
+    client.portal.call(db_redis.delete, counters)
+    cache = PostCache(Cache.post[0])
+    client.portal.call(cache.cached)
+
+    async def liked_after_query() -> Any:
+        row = await db_post.post_by_id(Cache.post[0])
+        await db_redis.hset(counters, mapping={"like": 7, "dislike": 0})
+        return row
+
+    client.portal.call(cache.load, liked_after_query)
+    assert client.portal.call(db_redis.hget, counters, "like") == "7"
+    client.portal.call(db_redis.delete, counters)
+
+
 def test_get_posts(client: Any, post: list) -> None:
     response = client.get("/api/posts/")
     assert response.status_code == status.HTTP_200_OK
@@ -54,6 +109,125 @@ def test_get_posts_page(client: Any, post: list) -> None:
             assert response.json()["results"][0]["text"] == post_index
 
 
+def test_get_posts_one_query(client: Any, mocker: Any) -> None:
+    calls = [mocker.spy(database, name) for name in ("fetch_one", "fetch_all", "execute")]
+    response = client.get("/api/posts/?page=2")
+    assert response.status_code == status.HTTP_200_OK
+    assert sum(i.call_count for i in calls) == 1
+
+
+def test_get_posts_total(client: Any, post: list) -> None:
+    response = client.get("/api/posts/?page=100")
+    assert response.json()["count"] == len(post)
+    assert response.json()["results"] == []
+
+    response = client.get("/api/posts/?total=estimate")
+    assert response.json()["count"] == len(post)
+    response = client.get(f"/api/posts/?total=estimate&author={Cache.user_one['id']}")
+    assert response.json()["count"] == len(post)
+
+    response = client.get(f"/api/posts/?total=none&limit=10&page={len(post) // 10 - 1}")
+    assert response.json()["count"] is None
+    assert len(response.json()["results"]) == 10
+    assert response.json()["next"] is not None
+    response = client.get(f"/api/posts/?total=none&limit=10&page={len(post) // 10}")
+    assert len(response.json()["results"]) == 10
+    assert response.json()["next"] is None
+
+
+def test_get_posts_cursor(client: Any, post: list) -> None:
+    url, texts, pages = "/api/posts/?cursor=&limit=7", [], []
+    while url:
+        response = client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["count"] == len(post)
+        texts += [i["text"] for i in response.json()["results"]]
+        pages.append(response.json())
+        url = response.json()["next"]
+    assert texts == [i["text"] for i in reversed(post)]
+    assert pages[0]["previous"] is None
+
+    response = client.get(pages[2]["previous"])
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["results"] == pages[1]["results"]
+    assert response.json()["next"] == pages[1]["next"]
+
+
+def test_get_posts_cursor_invalid(client: Any) -> None:
+    response = client.get("/api/posts/?cursor=invalid")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {"detail": "Invalid cursor"}
+    cursor = encode_cursor(datetime.now(timezone.utc), 2**31)
+    response = client.get(f"/api/posts/?cursor={cursor}")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_get_posts_etag(client: Any, mocker: Any) -> None:
+    url = "/api/posts/?limit=3"
+    first = client.get(url)
+    etag = first.headers["etag"]
+    calls = [mocker.spy(database, name) for name in ("fetch_one", "fetch_all", "execute")]
+    response = client.get(url)
+    assert response.json() == first.json()
+    assert sum(i.call_count for i in calls) == 0
+    response = client.get(url, headers={"if-none-match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    for like in (1, 0):
+        client.post(f"/api/posts/{Cache.post[-1]}/like", headers=Cache.headers_other)
+        response = client.get(url, headers={"if-none-match": etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["results"][0]["like"] == like
+        assert response.headers["etag"] != etag
+        etag = response.headers["etag"]
+
+
+def test_get_posts_cache_keys(client: Any) -> None:
+    def cached() -> int:
+        return len(client.portal.call(db_redis.keys, "feed:[0-9]*"))
+
+    client.get("/api/posts/?limit=2")
+    before = cached()
+    client.get("/api/posts/?limit=2&ref=1")
+    response = client.get("/api/posts/?cursor=&limit=2")
+    client.get(response.json()["next"])
+    assert cached() == before + 1
+
+
+def test_get_posts_links_relative(client: Any) -> None:
+    client.get("/api/posts/?limit=4", headers={"host": "forged.example"})
+    response = client.get("/api/posts/?limit=4")
+    assert response.json()["next"] == "/api/posts/?limit=4&page=2"
+
+
+def test_get_posts_fast_json(client: Any, mocker: Any) -> None:
+    mocker.patch("posts.api_posts.FEED_CACHE_PAGES", 0)
+    urls = ["/api/posts/?limit=20", "/api/posts/search?q=test", f"/api/posts/{Cache.post[-1]}"]
+    expected = [client.get(url).json() for url in urls]
+    mocker.patch("posts.serializers.FAST_JSON", True)
+    assert [client.get(url).json() for url in urls] == expected
+
+
+def test_search_posts(client: Any) -> None:
+    url, ids = "/api/posts/search?q=test&limit=20", []
+    while url:
+        response = client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        ids += [i["id"] for i in response.json()["results"]]
+        url = response.json()["next"]
+    assert ids == sorted(Cache.post, reverse=True)
+
+    response = client.get("/api/posts/search?q=test-7")
+    assert response.json()["results"][0]["text"] == "test-7"
+    response = client.get("/api/posts/search?q=nothing")
+    assert response.json()["results"] == []
+    response = client.get("/api/posts/search?q=test&cursor=invalid")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    cursor = encode_search_cursor(0.1, 2**31)
+    response = client.get(f"/api/posts/search?q=test&cursor={cursor}")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
 def test_post_update_other_client(client: Any) -> None:
     json = {"text": "post_update"}
     response = client.put(
@@ -72,6 +246,9 @@ def test_post_update(client: Any) -> None:
     )
     assert response.status_code == status.HTTP_200_OK
     assert response.json()["text"] == json["text"]
+    assert client.get(f"/api/posts/{Cache.post[0]}").json()["text"] == json["text"]
+    response = client.get("/api/posts/search?q=post_update")
+    assert [i["id"] for i in response.json()["results"]] == [Cache.post[0]]
 
 
 def test_post_delete_other_client(client: Any) -> None:
@@ -90,6 +267,11 @@ def test_post_delete(client: Any) -> None:
     )
     assert response.status_code == status.HTTP_404_NOT_FOUND
     assert response.json() == {"detail": "Removed"}
+    response = client.get(f"/api/posts/{Cache.post[0]}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    keys = [f"id={Cache.post[0]}", f"reactions={Cache.post[0]}"]
+    assert client.portal.call(db_redis.exists, *keys) == 0
+    assert client.portal.call(db_redis.hkeys, f"post={Cache.post[0]}") == ["version"]
 
 
 def test_post_like_no_post(client: Any) -> None:
@@ -115,6 +297,12 @@ def test_post_like(client: Any) -> None:
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {'dislike': 0, 'like': 1}
 
+    # the counters of a toggle that committed earlier arrive late
+    key = f"id={Cache.post[1]}"
+    stamp = int(client.portal.call(db_redis.hget, key, "stamp"))
+    client.portal.call(cache_counters, Cache.post[1], 0, 0, stamp - 1)
+    assert client.portal.call(db_redis.hmget, key, "like", "dislike") == ["1", "0"]
+
 
 def test_post_dislike_no_post(client: Any) -> None:
     response = client.post(
@@ -138,3 +326,252 @@ def test_post_dislike(client: Any) -> None:
     )
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {'dislike': 1, 'like': 0}
+
+
+def test_post_dislike_twice(client: Any) -> None:
+    response = client.post(
+        f"/api/posts/{Cache.post[1]}/dislike", headers=Cache.headers_other
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'dislike': 0, 'like': 0}
+
+
+def test_post_like_one_query(client: Any, mocker: Any) -> None:
+    client.get("/api/users/me", headers=Cache.headers_other)
+    calls = [mocker.spy(database, name) for name in ("fetch_one", "fetch_all", "execute")]
+    response = client.post(
+        f"/api/posts/{Cache.post[2]}/dislike", headers=Cache.headers_other
+    )
+    assert response.json() == {'dislike': 1, 'like': 0}
+    assert sum(i.call_count for i in calls) == 1
+
+
+def test_get_reactions(client: Any) -> None:
+    ids = f"{Cache.post[2]},{Cache.post[0]},{Cache.post[3]},{Cache.post[2]}"
+    for _ in range(2):
+        response = client.get(f"/api/posts/reactions?ids={ids}")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == [
+            {"id": Cache.post[2], "like": 0, "dislike": 1},
+            {"id": Cache.post[3], "like": 0, "dislike": 0},
+        ]
+
+
+def test_get_reactions_invalid(client: Any) -> None:
+    response = client.get("/api/posts/reactions?ids=1,a")
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    ids = ",".join(str(i) for i in range(1, 200))
+    response = client.get(f"/api/posts/reactions?ids={ids}")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.get(f"/api/posts/reactions?ids=1,{2**31}")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_get_reactions_keep_newer(client: Any, mocker: Any) -> None:
+    key = f"id={Cache.post[2]}"
+    client.portal.call(db_redis.delete, key)
+    count_many = db_like.count_many
+
+    async def liked_after_query(post_ids: list[int]) -> list:
+        records = await count_many(post_ids)
+        await db_redis.hset(key, mapping={"like": 7, "dislike": 0})
+        return records
+
+    mocker.patch.object(db_like, "count_many", liked_after_query)
+    client.get(f"/api/posts/reactions?ids={Cache.post[2]}")
+    assert client.portal.call(db_redis.hget, key, "like") == "7"
+    client.portal.call(db_redis.delete, key)
+
+
+def test_get_posts_counters(client: Any) -> None:
+    client.post(f"/api/posts/{Cache.post[1]}/like", headers=Cache.headers_other)
+    response = client.get(f"/api/posts/?author={Cache.user_one['id']}&limit=50")
+    assert response.status_code == status.HTTP_200_OK
+    result = {i["id"]: i for i in response.json()["results"]}[Cache.post[1]]
+    assert (result["like"], result["dislike"]) == (1, 0)
+
+    response = client.get(f"/api/posts/{Cache.post[1]}")
+    assert (response.json()["like"], response.json()["dislike"]) == (1, 0)
+
+
+def test_post_like_write_behind(client: Any, mocker: Any) -> None:
+    mocker.patch("posts.utils.REACTIONS_WRITE_BEHIND", True)
+    client.portal.call(reaction_buffer.create_group)
+    url = f"/api/posts/{Cache.post[3]}"
+    response = client.post(f"{url}/like", headers=Cache.headers_other)
+    assert response.json() == {'dislike': 0, 'like': 1}
+    response = client.post(f"{url}/dislike", headers=Cache.headers_other)
+    assert response.json() == {'dislike': 1, 'like': 0}
+    response = client.post(f"{url}/like", headers=Cache.headers)
+    assert response.status_code == status.HTTP_418_IM_A_TEAPOT
+    assert client.get(url).json()["dislike"] == 1
+    assert client.portal.call(db_like.count, Cache.post[3])["dislike"] == 0
+
+    # a worker reads the entries and stops before writing them
+    client.portal.call(partial(
+        db_redis.xreadgroup, REACTIONS_GROUP, "stopped", {REACTIONS_LOG: ">"}
+    ))
+    mocker.patch.object(reaction_buffer, "claim_idle", 0)
+    assert client.portal.call(reaction_buffer.flush) == 2
+    assert client.portal.call(reaction_buffer.flush) == 0
+    record = client.portal.call(db_like.count, Cache.post[3])
+    assert (record["like"], record["dislike"]) == (0, 1)
+
+
+def test_follow(client: Any) -> None:
+    one, other = Cache.user_one["id"], Cache.user_other["id"]
+    response = client.post(f"/api/users/{other}/follow", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post("/api/users/100000/follow", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = client.post(f"/api/users/{2**31}/follow", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    for _ in range(2):
+        response = client.post(f"/api/users/{one}/follow", headers=Cache.headers_other)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"detail": "Followed"}
+
+
+def test_get_timeline(client: Any) -> None:
+    response = client.get("/api/posts/timeline?limit=5", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_200_OK
+    first = response.json()["results"]
+    assert [i["id"] for i in first] == Cache.post[:-6:-1]
+    assert response.json()["next"] is not None
+
+    response = client.post("/api/posts/create", json={"text": "timeline"}, headers=Cache.headers)
+    Cache.post.append(response.json()["id"])
+    response = client.get("/api/posts/timeline?limit=5", headers=Cache.headers_other)
+    assert [i["id"] for i in response.json()["results"]] == Cache.post[:-6:-1]
+    key = f"timeline={Cache.user_other['id']}"
+    assert client.portal.call(db_redis.zscore, key, Cache.post[-1]) is not None
+
+
+def test_get_timeline_fan_out_on_read(client: Any, mocker: Any) -> None:
+    mocker.patch("posts.utils.TIMELINE_FANOUT_MAX", 0)
+    mocker.patch("posts.models.TIMELINE_FANOUT_MAX", 0)
+    response = client.post("/api/posts/create", json={"text": "celebrity"}, headers=Cache.headers)
+    Cache.post.append(response.json()["id"])
+    key = f"timeline={Cache.user_other['id']}"
+    assert client.portal.call(db_redis.zscore, key, Cache.post[-1]) is None
+    response = client.get("/api/posts/timeline?limit=5", headers=Cache.headers_other)
+    assert [i["id"] for i in response.json()["results"]] == Cache.post[:-6:-1]
+
+
+def test_unfollow(client: Any) -> None:
+    one = Cache.user_one["id"]
+    response = client.post(f"/api/users/{one}/unfollow", headers=Cache.headers_other)
+    assert response.status_code == status.HTTP_200_OK
+    response = client.get("/api/posts/timeline", headers=Cache.headers_other)
+    assert response.json()["results"] == []
+
+
+def test_post_import(client: Any, mocker: Any) -> None:
+    mocker.patch("posts.importer.POSTS_IMPORT_BATCH", 2)
+    other = Cache.user_other["id"]
+    body = "\n".join([
+        '{"text": "imported ndjson", "timestamp": "2020-01-01T00:00:00+00:00"}',
+        "not json",
+        '{"text": "imported again"}',
+        f'{{"text": "imported", "author": {other}}}',
+        '{"timestamp": "2020-01-01"}',
+    ])
+    headers = {**Cache.headers, "content-type": "application/x-ndjson"}
+    response = client.post("/api/posts/import", content=body, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"imported": 2, "failed": 3, "errors": [
+        {"line": 2, "detail": "Invalid JSON"},
+        {"line": 4, "detail": "Only your own posts"},
+        {"line": 5, "detail": "text - field required; timestamp - invalid datetime format"},
+    ]}
+
+    body = 'text,timestamp\n"imported\ncsv, quoted",2020-01-02T00:00:00Z\nimported plain,\n'
+    headers = {**Cache.headers, "content-type": "text/csv"}
+    response = client.post("/api/posts/import", content=body, headers=headers)
+    assert response.json() == {"imported": 2, "failed": 0, "errors": []}
+
+    results = client.get("/api/posts/search?q=imported&limit=20").json()["results"]
+    assert {i["text"] for i in results} == {
+        "imported again", "imported ndjson", "imported plain", "imported\ncsv, quoted"
+    }
+    assert {i["author"] for i in results} == {Cache.user_one["id"]}
+
+    response = client.post("/api/posts/import", content="{}", headers=Cache.headers)
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+
+def test_post_import_invalid(client: Any) -> None:
+    long = "x" * 200_000
+    half = "y" * 600_000
+    body = f'text\n"{long}"\n"{half}\n{half}"\n'
+    headers = {**Cache.headers, "content-type": "text/csv"}
+    response = client.post("/api/posts/import", content=body, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["imported"] == 1
+    assert response.json()["errors"][0]["line"] == 3
+    assert response.json()["errors"][0]["detail"].startswith("Invalid CSV")
+
+    body = '{"text": "a\\ud800b"}'
+    headers = {**Cache.headers, "content-type": "application/x-ndjson"}
+    response = client.post("/api/posts/import", content=body, headers=headers)
+    assert response.json()["errors"] == [{"line": 1, "detail": "text - not valid Unicode"}]
+
+    async def chunks() -> AsyncIterator[bytes]:
+        yield f'{{"text": "far", "author": {2**31}}}'.encode()
+
+    result = client.portal.call(import_posts, chunks(), "ndjson", Cache.user_one["id"])
+    assert result.errors == [PostImportError(line=1, detail="No such author")]
+
+
+def test_get_posts_limit_max(client: Any) -> None:
+    for url in ("/api/posts/", "/api/posts/search?q=test", "/api/posts/timeline"):
+        response = client.get(f"{url}{'&' if '?' in url else '?'}limit=101", headers=Cache.headers)
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_export_posts(client: Any, mocker: Any) -> None:
+    mocker.patch("posts.serializers.EXPORT_CHUNK", 2)
+    count = client.get("/api/posts/").json()["count"]
+    iterate = mocker.spy(exports, "iterate")
+    response = client.get("/api/posts/export")
+    assert response.status_code == status.HTTP_200_OK
+    assert iterate.call_count == 1
+    assert response.headers["content-type"] == "application/x-ndjson"
+    posts = [json.loads(line) for line in response.text.splitlines()]
+    assert len(posts) == count > 2
+    assert set(posts[0]) == set(PostDetail.__fields__)
+    assert [i["timestamp"] for i in posts] == sorted((i["timestamp"] for i in posts), reverse=True)
+
+    author = Cache.user_other["id"]
+    response = client.get(f"/api/posts/export?author={author}")
+    count = client.get(f"/api/posts/?author={author}").json()["count"]
+    assert [i["author"] for i in map(json.loads, response.text.splitlines())] == [author] * count
+
+
+def test_read_replica(client: Any, mocker: Any) -> None:
+    replica = databases.Database(DATABASE_URL)
+    client.portal.call(replica.connect)
+    client.portal.call(db_redis.delete, f"wrote={Cache.user_other['id']}")
+    configured, replicas[:] = replicas[:], [replica]
+    try:
+        reads = [mocker.spy(replica, name) for name in ("fetch_one", "fetch_all")]
+        url, one = f"/api/posts/{Cache.post[-1]}", Cache.user_one["id"]
+        profile = f"/api/users/{one}"
+        for path in ("/api/posts/?page=9", profile):
+            assert client.get(path).status_code == status.HTTP_200_OK
+        assert sum(i.call_count for i in reads) == 2
+
+        response = client.put(url, json={"text": "replica"}, headers=Cache.headers_other)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        client.get(profile, headers=Cache.headers_other)
+        assert sum(i.call_count for i in reads) == 3
+
+        client.post(f"/api/users/{one}/follow", headers=Cache.headers_other)
+        client.get(profile, headers=Cache.headers_other)
+        assert sum(i.call_count for i in reads) == 3
+        client.get(profile)
+        assert sum(i.call_count for i in reads) == 4
+        client.post(f"/api/users/{one}/unfollow", headers=Cache.headers_other)
+    finally:
+        replicas[:] = configured
+        client.portal.call(replica.disconnect)
@@ -1,19 +1,18 @@
 from typing import Any
 
-from db import database
+from db import database, replicas
 from fastapi import APIRouter, Depends, status
 from fastapi.responses import JSONResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm as OAuth2Form
-from redis import Redis
-from settings import JWT_REFRESH_SECRET_KEY, REDIS_URL
+from metrics import TimedRoute
+from settings import JWT_REFRESH_SECRET_KEY
 from starlette.requests import Request
 from users import utils
 from users.models import User
 from users.schemas import TokenBase, TokenSchema, UserOut
 
-router = APIRouter(prefix='/auth', tags=["auth"])
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
-db_user = User(database)
+router = APIRouter(prefix='/auth', tags=["auth"], route_class=TimedRoute)
+db_user = User(database, replicas)
 
 
 @router.post("/token/login", response_model=TokenSchema, status_code=status.HTTP_200_OK)
@@ -31,20 +30,21 @@ async def login(request: Request, user: OAuth2Form = Depends()) -> Any:
             status.HTTP_400_BAD_REQUEST
         )
     if request.client is not None:
-        return await utils.redis_count_token_and_save(user_cls.id, request.client.host)
+        return await utils.save_tokens(user_cls.id, request.client.host)
 
 
 @router.post('/token/refresh', response_model=TokenSchema, status_code=status.HTTP_200_OK)
 async def refresh_token(request: Request, token: TokenBase) -> Any:
     if request.client is not None:
         user_id = await utils.check_token(
-            token.refresh_token, JWT_REFRESH_SECRET_KEY, request.client.host
+            token.refresh_token, JWT_REFRESH_SECRET_KEY, refresh=True
         )
         if user_id:
-            return await utils.redis_count_token_and_save(user_id, request.client.host)
+            return await utils.rotate_tokens(user_id, request.client.host, token.refresh_token)
         return RedirectResponse('/api/auth/token/login', status.HTTP_302_FOUND)
 
 
 @router.post("/token/logout", status_code=status.HTTP_404_NOT_FOUND)
 async def logout(user: UserOut = Depends(utils.get_current_user)) -> None:
-    db_redis.delete(f"user={user.id}")
+    await utils.end_sessions(user.id)
+    utils.user_cache.delete(user.id)
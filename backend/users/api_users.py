@@ -1,14 +1,18 @@
-from db import database
-from fastapi import APIRouter, Depends, status
+from db import database, db_redis, replicas
+from fastapi import APIRouter, Depends, Path, status
 from fastapi.responses import JSONResponse
-from settings import NOT_FOUND
-from users.models import User
+from metrics import TimedRoute
+from settings import ID_MAX, NOT_FOUND
+from users.models import Follow, User
 from users.schemas import SetPassword, UserCreate, UserOut, UserPassword
-from users.utils import get_current_user, get_hashed_password, verify_password
+from users.utils import (get_current_user, get_hashed_password, user_cache,
+                         verify_password)
 
-router = APIRouter(prefix='/users', tags=["users"])
-db_user = User(database)
+router = APIRouter(prefix='/users', tags=["users"], route_class=TimedRoute)
+db_user = User(database, replicas)
+db_follow = Follow(database)
 PROTECTED = Depends(get_current_user)
+USER_ID = Path(..., le=ID_MAX)
 
 
 @router.post("/signup", response_model=UserOut, status_code=status.HTTP_201_CREATED)
@@ -34,22 +38,46 @@ async def me(user: UserOut = PROTECTED) -> UserOut:
 
 
 @router.get("/{pk}", response_model=UserOut, status_code=status.HTTP_200_OK)
-async def user_id(pk: int) -> UserOut | JSONResponse:
+async def user_id(pk: int = USER_ID) -> UserOut | JSONResponse:
     """ User profile. Available to all users. """
     return await db_user.user_by_id(pk) or NOT_FOUND
 
 
 @router.put("/set_password", status_code=status.HTTP_200_OK)
 async def set_password(user_pas: SetPassword, user: UserPassword = PROTECTED) -> JSONResponse:
-    if not await verify_password(user_pas.current_password, user.password):
+    """ The current password is checked against Postgres, not the cached user. """
+    current = await db_user.password_by_id(user.id)
+    if not current or not await verify_password(user_pas.current_password, current.password):
         return JSONResponse(
             {"detail": "Incorrect password"}, status.HTTP_400_BAD_REQUEST
         )
     password_hashed = await get_hashed_password(user_pas.new_password)
-    if not await db_user.update_password(password_hashed, user.id):
+    if not await db_user.update_password(password_hashed, user.id, current.password):
         return JSONResponse(
             {"detail": "Error"}, status.HTTP_401_UNAUTHORIZED
         )
+    user_cache.delete(user.id)
     return JSONResponse(
         {"detail": "Changed"}, status.HTTP_200_OK
     )
+
+
+@router.post("/{pk}/follow", status_code=status.HTTP_200_OK)
+async def follow(pk: int = USER_ID, user: UserOut = PROTECTED) -> JSONResponse:
+    """ The home timeline is rebuilt with the author's posts on the next read. """
+    if pk == user.id:
+        return JSONResponse(
+            {"detail": "You cannot follow yourself"}, status.HTTP_400_BAD_REQUEST
+        )
+    if not await db_follow.follow(user.id, pk):
+        return NOT_FOUND
+    await db_redis.delete(f"timeline={user.id}")
+    return JSONResponse({"detail": "Followed"}, status.HTTP_200_OK)
+
+
+@router.post("/{pk}/unfollow", status_code=status.HTTP_200_OK)
+async def unfollow(pk: int = USER_ID, user: UserOut = PROTECTED) -> JSONResponse:
+    if not await db_follow.unfollow(user.id, pk):
+        return NOT_FOUND
+    await db_redis.delete(f"timeline={user.id}")
+    return JSONResponse({"detail": "Unfollowed"}, status.HTTP_200_OK)
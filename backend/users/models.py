@@ -1,6 +1,7 @@
 from asyncpg import Record
 from db import Base, metadata
-from sqlalchemy import Column, DateTime, Integer, String, Table, insert, select
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, String, Table,
+                        bindparam, insert, select, text)
 from sqlalchemy.sql import func
 from users.schemas import UserCreate
 
@@ -13,19 +14,70 @@ users = Table(
     Column("first_name", String(150)),
     Column("last_name", String(150)),
     Column("timestamp", DateTime(timezone=True), default=func.now()),
+    Column("followers_count", Integer, nullable=False, server_default="0"),
+)
+follows = Table(
+    "follows", metadata,
+    Column(
+        "follower_id", Integer,
+        ForeignKey("users.id", ondelete='CASCADE'), primary_key=True
+    ),
+    Column(
+        "author_id", Integer,
+        ForeignKey("users.id", ondelete='CASCADE'), primary_key=True, index=True
+    ),
+    Column("timestamp", DateTime(timezone=True), server_default=func.now()),
+)
+
+""" Both return the author id, or nothing if there is no such user. """
+FOLLOW = text(
+    """
+    WITH author AS (
+        SELECT id FROM users WHERE id = :author_id
+    ),
+    followed AS (
+        INSERT INTO follows (follower_id, author_id)
+        SELECT :follower_id, id FROM author
+        ON CONFLICT DO NOTHING
+        RETURNING author_id
+    ),
+    counted AS (
+        UPDATE users SET followers_count = users.followers_count + 1
+        FROM followed WHERE users.id = followed.author_id
+        RETURNING users.id
+    )
+    SELECT id FROM author
+    """
+)
+UNFOLLOW = text(
+    """
+    WITH unfollowed AS (
+        DELETE FROM follows
+        WHERE follower_id = :follower_id AND author_id = :author_id
+        RETURNING author_id
+    ),
+    counted AS (
+        UPDATE users SET followers_count = users.followers_count - 1
+        FROM unfollowed WHERE users.id = unfollowed.author_id
+        RETURNING users.id
+    )
+    SELECT id FROM users WHERE id = :author_id
+    """
 )
 
 
 class User(Base):
     async def user_by_id(self, pk: int) -> Record:
-        return await self.database.fetch_one(
-            select(users).where(users.c.id == pk)
-        )
+        return await self.read_one(self.prepared(
+            "user_by_id", lambda: select(users).where(users.c.id == bindparam("pk")), pk=pk
+        ))
 
     async def user_by_username(self, username: str) -> Record:
-        return await self.database.fetch_one(
-            select(users).where(users.c.username == username)
-        )
+        return await self.database.fetch_one(self.prepared(
+            "user_by_username",
+            lambda: select(users).where(users.c.username == bindparam("username")),
+            username=username,
+        ))
 
     async def check_by_email(self, email: str) -> Record | None:
         return await self.database.fetch_one(
@@ -38,12 +90,22 @@ class User(Base):
         )
 
     async def id_password_by_username(self, username: str) -> Record | None:
-        query = await self.database.fetch_one(
-            select(users.c.id, users.c.password)
-            .where(users.c.username == username)
-        )
+        query = await self.database.fetch_one(self.prepared(
+            "id_password_by_username",
+            lambda: select(users.c.id, users.c.password)
+            .where(users.c.username == bindparam("username")),
+            username=username,
+        ))
         return query
 
+    async def password_by_id(self, pk: int) -> Record | None:
+        """ From the primary, a cached user may keep a password changed since. """
+        return await self.database.fetch_one(self.prepared(
+            "password_by_id",
+            lambda: select(users.c.password).where(users.c.id == bindparam("pk")),
+            pk=pk,
+        ))
+
     async def create(self, user: UserCreate) -> int:
         return await self.database.execute(
             insert(users).values(
@@ -55,10 +117,32 @@ class User(Base):
             ).returning(users.c.id)
         )
 
-    async def update_password(self, password: str, user_id: int) -> Record | None:
+    async def update_password(self, password: str, user_id: int, current: str) -> Record | None:
+        """ Only while the hash is still current, a change in between wins. """
         return await self.database.execute(
             users.update()
-            .where(users.c.id == user_id)
+            .where(users.c.id == user_id, users.c.password == current)
             .values(password=password)
             .returning(users.c.id)
         )
+
+
+class Follow(Base):
+    async def follow(self, follower_id: int, author_id: int) -> Record | None:
+        """ Following twice changes nothing. """
+        return await self.database.fetch_one(
+            FOLLOW.bindparams(follower_id=follower_id, author_id=author_id)
+        )
+
+    async def unfollow(self, follower_id: int, author_id: int) -> Record | None:
+        return await self.database.fetch_one(
+            UNFOLLOW.bindparams(follower_id=follower_id, author_id=author_id)
+        )
+
+    async def follower_ids(self, author_id: int, limit: int) -> list[int]:
+        records = await self.database.fetch_all(
+            select(follows.c.follower_id)
+            .where(follows.c.author_id == author_id)
+            .limit(limit)
+        )
+        return [record["follower_id"] for record in records]
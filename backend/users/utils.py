@@ -1,40 +1,159 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any
+from typing import Any, Callable
 
 import settings
-from db import database
+from db import database, db_redis, replicas
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
+from metrics import cache_result
 from passlib.hash import bcrypt
 from pydantic import ValidationError
-from redis import Redis
-from settings import REDIS_URL
 from users.models import User
 from users.schemas import TokenPayload
 
-db_user = User(database)
-db_redis = Redis.from_url(REDIS_URL, decode_responses=True)
+db_user = User(database, replicas)
 oauth2_scheme = OAuth2PasswordBearer(
     tokenUrl="/api/auth/token/login",
     scheme_name="JWT"
 )
 
+"""
+Sessions of a user: KEYS[1] maps the host to its refresh token,
+KEYS[2] orders the hosts by the time of login in milliseconds.
+Both expire with the newest session.
+"""
+SESSION_KEYS = "user={}", "sessions={}"
+
+"""
+ARGV: host, token, now, the most sessions, lifetime in seconds.
+Saves the session, drops the expired ones and the oldest past the limit.
+"""
+SESSION_SAVE = db_redis.register_script(
+    """
+    local ttl = tonumber(ARGV[5])
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+    local ended = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - ttl * 1000)
+    local extra = redis.call('ZCARD', KEYS[2]) - #ended - tonumber(ARGV[4])
+    if extra > 0 then
+        for _, host in ipairs(redis.call('ZRANGE', KEYS[2], #ended, #ended + extra - 1)) do
+            table.insert(ended, host)
+        end
+    end
+    if #ended > 0 then
+        redis.call('HDEL', KEYS[1], unpack(ended))
+        redis.call('ZREM', KEYS[2], unpack(ended))
+    end
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+    """
+)
+
+"""
+ARGV: host, the presented token, the new token, now, lifetime in seconds.
+Replaces the token of the host if it is the one presented and returns 1.
+Any other token ends the session of the host and returns 0.
+"""
+SESSION_ROTATE = db_redis.register_script(
+    """
+    local score = redis.call('ZSCORE', KEYS[2], ARGV[1])
+    local expired = score and tonumber(score) < tonumber(ARGV[4]) - tonumber(ARGV[5]) * 1000
+    if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] or expired then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    return 1
+    """
+)
+
+
+class HashPool:
+    """
+    Runs bcrypt in a few threads so it does not hold up the event loop.
+    Calls waiting over the queue limit are refused instead of piling up.
+    """
+    def __init__(self, workers: int, queue: int):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="bcrypt")
+        self.queue = queue
+        self.pending = 0
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        if self.pending >= self.queue:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+
+hash_pool = HashPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_QUEUE)
+
+
+class TTLCache:
+    """ Per-process LRU, every entry also expires after ttl seconds. """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        return item[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def delete(self, key: Any) -> None:
+        self.data.pop(key, None)
+
+
+user_cache = TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
 
 async def get_hashed_password(password: str) -> str:
     """ Hashes the user's password. """
-    return bcrypt.hash(password)
+    return await hash_pool.run(bcrypt.hash, password)
 
 
 async def verify_password(password: str, hashed_pass: str) -> bool:
     """ Validates a hashed user password. """
-    return bcrypt.verify(password, hashed_pass)
+    return await hash_pool.run(bcrypt.verify, password, hashed_pass)
 
 
 async def _get_token(sub: int, secret: str, expire_minutes: int) -> str:
-    """ Called from create_access_token and create_refresh_token. """
+    """
+    Called from create_access_token and create_refresh_token.
+    jti tells apart the tokens issued in the same second.
+    """
     exp = datetime.utcnow() + timedelta(minutes=expire_minutes)
-    to_encode = {"exp": exp, "sub": str(sub)}
+    to_encode = {"exp": exp, "sub": str(sub), "jti": secrets.token_hex(8)}
     encoded_jwt = jwt.encode(to_encode, secret, settings.ALGORITHM)
     return encoded_jwt
 
@@ -57,17 +176,21 @@ async def create_refresh_token(sub: int) -> str:
     )
 
 
-async def check_token(token: str, secret: str, refresh_host: str = '') -> Any:
-    """
-    Checks the token time.
-    if refresh_token checks if the IP address exists in the database.
-    if not, removes all tokens
-    """
-    exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Invalid credentials',
         headers={'WWW-Authenticate': 'Bearer'}
     )
+
+
+async def check_token(token: str, secret: str, refresh: bool = False) -> Any:
+    """
+    Checks the token time.
+    A refresh token only gives the user id,
+    rotate_tokens checks it against the session.
+    """
+    exception = credentials_exception()
     try:
         payload = jwt.decode(
             token, secret, algorithms=[settings.ALGORITHM]
@@ -76,30 +199,63 @@ async def check_token(token: str, secret: str, refresh_host: str = '') -> Any:
 
         if datetime.fromtimestamp(token_data.exp) < datetime.now():
             raise exception
-        if refresh_host:
-            if db_redis.hmget(f"user={token_data.sub}", refresh_host)[0] == token:
-                return token_data.sub
-            db_redis.hdel(f"user={token_data.sub}", refresh_host)
-            raise exception
+        if refresh:
+            return token_data.sub
 
     except (JWTError, ValidationError):
         raise exception
 
-    user = await db_user.user_by_id(token_data.sub)
-    if not user:
-        raise exception
+    user = user_cache.get(token_data.sub)
+    cache_result("token_user", user is not None)
+    if user is None:
+        user = await db_user.user_by_id(token_data.sub)
+        if not user:
+            raise exception
+        user_cache.set(token_data.sub, user)
     return user
 
 
-async def redis_count_token_and_save(user_id: int, host: str) -> dict[str, str]:
+def _session_keys(user_id: int) -> list[str]:
+    return [key.format(user_id) for key in SESSION_KEYS]
+
+
+async def save_tokens(user_id: int, host: str) -> dict[str, str]:
+    """ Starts a session of the user on the host in one round trip. """
     access_token = await create_access_token(user_id)
     refresh_token = await create_refresh_token(user_id)
+    await SESSION_SAVE(_session_keys(user_id), [
+        host,
+        refresh_token,
+        int(time.time() * 1000),
+        settings.REFRESH_SESSIONS_MAX,
+        settings.REFRESH_TOKEN_EXPIRE_MINUTES * 60,
+    ])
+    return {"access_token": access_token, "refresh_token": refresh_token}
 
-    if len(db_redis.hgetall(f"user={user_id}")) > 10:
-        db_redis.delete(f"user={user_id}")
-    db_redis.hmset(f"user={user_id}", {host: refresh_token})
 
-    return {"access_token": access_token, "refresh_token": refresh_token}
+async def rotate_tokens(user_id: int, host: str, refresh_token: str) -> dict[str, str]:
+    """
+    New tokens for the refresh token of the session on this host, in one round trip.
+    A token that is not the current one ends the session, it may have been stolen.
+    """
+    tokens = {
+        "access_token": await create_access_token(user_id),
+        "refresh_token": await create_refresh_token(user_id),
+    }
+    rotated = await SESSION_ROTATE(_session_keys(user_id), [
+        host,
+        refresh_token,
+        tokens["refresh_token"],
+        int(time.time() * 1000),
+        settings.REFRESH_TOKEN_EXPIRE_MINUTES * 60,
+    ])
+    if not rotated:
+        raise credentials_exception()
+    return tokens
+
+
+async def end_sessions(user_id: int) -> None:
+    await db_redis.delete(*_session_keys(user_id))
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> type: